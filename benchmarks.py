@@ -0,0 +1,1016 @@
+"""
+Discord Mouse Controller - Benchmarks
+在本機假 Discord IPC 伺服器上量測按鍵到送出封包的延遲
+
+Usage:
+    python benchmarks.py latency [--iterations N] [--input mouse|keyboard] [--stages]
+    python benchmarks.py hold [--iterations N] [--typing-rate KEYS_PER_SEC]
+    python benchmarks.py threads [--events N]
+    python benchmarks.py hook [--events N]
+    python benchmarks.py frames [--iterations N]
+    python benchmarks.py keynames [--iterations N]
+    python benchmarks.py replay [--trace PATH] [--speed X] [--keys N]
+    python benchmarks.py load [--keys N] [--speed X]
+    python benchmarks.py reconnect [--cycles N] [--downtime SECONDS]
+    python benchmarks.py startup [--runs N] [--budget-ms MS]
+    python benchmarks.py memory [--settle SECONDS]
+
+The fake server listens on a Unix socket, so the latency benchmark runs on
+Linux / macOS only (Windows uses named pipes). pynput needs an X display to
+import on Linux; on a headless box run under Xvfb (xvfb-run python benchmarks.py ...).
+"""
+
+import argparse
+import asyncio
+import atexit
+import contextlib
+import json
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+import discord_mouse_rpc
+from discord_mouse_rpc import (DiscordAPI, DiscordIPC, InputEventRing, InputTraceWriter,
+                               SyntheticInputSource, VoiceFrameBuilder, replay_input_trace)
+from pynput import mouse, keyboard
+
+
+# === Fake Discord IPC Server ===
+
+class FakeDiscordIPC:
+    """Minimal stand-in for the Discord client's IPC socket (framing, READY, voice replies)"""
+
+    def __init__(self, path, respond=True):
+        self.path = path
+        self.respond = respond
+        self.voice = {'mute': False, 'deaf': False}
+        self.frames = []  # (perf_counter_ns, payload) per received command
+        self.frame_event = threading.Event()
+        self._lock = threading.Lock()
+        self._sock = None
+        self._conns = []
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(8)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def stop(self):
+        """Shut down like a closing Discord: endpoint gone, clients disconnected"""
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            with contextlib.suppress(OSError):
+                conn.shutdown(socket.SHUT_RDWR)
+
+    def frame_count(self):
+        with self._lock:
+            return len(self.frames)
+
+    def wait_for_frames(self, count, timeout=5.0):
+        """Block until at least ``count`` command frames have arrived"""
+        deadline = time.monotonic() + timeout
+        while self.frame_count() < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.frame_event.wait(remaining)
+            self.frame_event.clear()
+        return True
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                self._conns.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                header = self._recv_exact(conn, 8)
+                if header is None:
+                    return
+                op, length = struct.unpack('<II', header)
+                body = self._recv_exact(conn, length)
+                if body is None:
+                    return
+                received_ns = time.perf_counter_ns()
+
+                if op == 0:
+                    # Handshake -> READY
+                    self._send(conn, 1, {
+                        'cmd': 'DISPATCH',
+                        'evt': 'READY',
+                        'data': {'v': 1, 'user': {'id': '0', 'username': 'benchmark'}},
+                        'nonce': None
+                    })
+                elif op == 1:
+                    payload = json.loads(body)
+                    with self._lock:
+                        self.frames.append((received_ns, payload))
+                    self.frame_event.set()
+                    if self.respond:
+                        self._reply(conn, payload)
+                elif op == 2:
+                    return
+
+    def _reply(self, conn, payload):
+        cmd = payload.get('cmd')
+        if cmd == 'SET_VOICE_SETTINGS':
+            self.voice.update(payload.get('args') or {})
+            data = dict(self.voice)
+        elif cmd == 'AUTHORIZE':
+            data = {'code': 'benchmark-code'}
+        else:
+            data = {}
+        try:
+            self._send(conn, 1, {'cmd': cmd, 'evt': None, 'data': data, 'nonce': payload.get('nonce')})
+            if cmd == 'SET_VOICE_SETTINGS':
+                self._send(conn, 1, {'cmd': 'DISPATCH', 'evt': 'VOICE_SETTINGS_UPDATE',
+                                     'data': data, 'nonce': None})
+        except OSError:
+            pass
+
+    @staticmethod
+    def _recv_exact(conn, size):
+        buf = b''
+        while len(buf) < size:
+            try:
+                chunk = conn.recv(size - len(buf))
+            except OSError:
+                return None
+            if not chunk:
+                return None
+            buf += chunk
+        return buf
+
+    @staticmethod
+    def _send(conn, op, payload):
+        encoded = json.dumps(payload).encode('utf-8')
+        conn.sendall(struct.pack('<II', op, len(encoded)) + encoded)
+
+
+# === Helpers ===
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def make_stimulus(api, kind):
+    """Return (binding, fire) where fire() delivers one press+release"""
+    if kind == 'keyboard':
+        key = keyboard.KeyCode.from_char('m')
+
+        def fire():
+            api.on_key_press(key)
+            api.on_key_release(key)
+        return 'M', fire
+
+    def fire():
+        api.on_click(0, 0, mouse.Button.x2, True)
+        api.on_click(0, 0, mouse.Button.x2, False)
+    return 'Mouse5', fire
+
+
+@contextlib.contextmanager
+def fake_discord(respond=True):
+    """Run a FakeDiscordIPC where find_ipc_path() will look for discord-ipc-0"""
+    tmpdir = tempfile.mkdtemp(prefix='dmc-bench-')
+    old_runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    os.environ['XDG_RUNTIME_DIR'] = tmpdir
+    server = FakeDiscordIPC(os.path.join(tmpdir, 'discord-ipc-0'), respond=respond)
+    server.start()
+    try:
+        yield server
+    finally:
+        server.stop()
+        if old_runtime_dir is None:
+            os.environ.pop('XDG_RUNTIME_DIR', None)
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = old_runtime_dir
+        with contextlib.suppress(OSError):
+            os.rmdir(tmpdir)
+
+
+_config_dir = None
+
+
+def bench_api(config=None):
+    """A DiscordAPI without OS hooks, loading config (a raw config dict) from a throwaway config.json"""
+    global _config_dir
+    if _config_dir is None:
+        # Never read, watch, overwrite or quarantine the user's config.json
+        _config_dir = tempfile.mkdtemp(prefix='dmc-bench-config-')
+        atexit.register(shutil.rmtree, _config_dir, True)
+        discord_mouse_rpc.CONFIG_FILE = os.path.join(_config_dir, 'config.json')
+    with open(discord_mouse_rpc.CONFIG_FILE, 'w') as f:
+        json.dump(config or {}, f)
+    return DiscordAPI(start_listeners=False)
+
+
+@contextlib.contextmanager
+def connected_api(server):
+    """A DiscordAPI without OS hooks, connected to the fake server"""
+    api = bench_api()
+    api.running = True
+
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    api.loop = loop
+
+    client = DiscordIPC('0', api._on_rpc_message, api.frames.next_nonce)
+
+    async def connect():
+        await client.connect()
+        api.rpc_client = client
+        api._start_sender(client)
+
+    asyncio.run_coroutine_threadsafe(connect(), loop).result(timeout=5)
+
+    try:
+        yield api
+    finally:
+        api.running = False
+        loop.call_soon_threadsafe(client.close)
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join(timeout=1)
+
+
+# === Benchmarks ===
+
+def bench_latency(iterations=1000, throughput_toggles=1000, input_kind='mouse', stages=False):
+    """Input event -> SET_VOICE_SETTINGS frame received by the fake server"""
+    with fake_discord() as server, connected_api(server) as api:
+        binding, fire = make_stimulus(api, input_kind)
+        api._update_config({'btn_mute': binding})
+        api.set_latency_tracing(stages)
+
+        latencies = []
+        # The handlers print on every trigger; keep that cost but not the noise
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # Latency: one toggle in flight at a time
+            for _ in range(iterations):
+                expected = server.frame_count() + 1
+                start_ns = time.perf_counter_ns()
+                fire()
+                if not server.wait_for_frames(expected):
+                    raise RuntimeError("Timed out waiting for SET_VOICE_SETTINGS frame")
+                latencies.append(server.frames[expected - 1][0] - start_ns)
+            # Let the last response arrive before reading the ack stage
+            deadline = time.monotonic() + 5
+            while api.voice_state.pending_count() and time.monotonic() < deadline:
+                time.sleep(0.0005)
+            stage_stats = api.get_latency_histograms()['stages'] if stages else None
+
+            # Throughput: fire back-to-back until every toggle has been
+            # written, merged into a queued frame or rejected by the sender
+            sender = api.rpc_sender
+            while sender.sent < server.frame_count():
+                time.sleep(0.0005)  # last latency frame arrived but not yet counted
+            base_sent = sender.sent
+            base_handled = sender.sent + sender.merged + sender.rejected
+            base_frames = server.frame_count()
+            start_ns = time.perf_counter_ns()
+            for i in range(throughput_toggles):
+                fire()
+                if i % 256 == 255:
+                    # Stay within the input ring instead of measuring drops
+                    api.input_ring.wait_idle(5)
+            deadline = time.monotonic() + 30
+            while sender.sent + sender.merged + sender.rejected - base_handled < throughput_toggles:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Timed out waiting for throughput toggles")
+                time.sleep(0.0005)
+            frames_written = sender.sent - base_sent
+            if not server.wait_for_frames(base_frames + frames_written, timeout=30):
+                raise RuntimeError("Timed out waiting for throughput frames")
+            elapsed_ns = time.perf_counter_ns() - start_ns
+
+    latencies.sort()
+    return {
+        'input': input_kind,
+        'iterations': iterations,
+        'p50_us': percentile(latencies, 0.50) / 1000,
+        'p99_us': percentile(latencies, 0.99) / 1000,
+        'max_us': latencies[-1] / 1000,
+        'toggles_per_sec': throughput_toggles / (elapsed_ns / 1e9),
+        'frames_written': frames_written,
+        'dropped': api.input_ring.dropped + sender.rejected,
+        'stages': stage_stats,
+    }
+
+
+HOLD_BUDGET_MS = 10  # press -> SET_VOICE_SETTINGS frame, p99
+
+
+def bench_hold_latency(iterations=200, typing_rate=500):
+    """Push-to-talk press / release -> frame latency while typing runs flat out"""
+    with fake_discord() as server, connected_api(server) as api:
+        api._update_config({'bindings': {'ptt': ['Mouse5']}})
+        letters = [keyboard.KeyCode.from_char(c) for c in TYPING_TEXT if c != ' ']
+        stop = threading.Event()
+        typed = [0]
+
+        def type_heavily():
+            interval = 1 / typing_rate
+            i = 0
+            while not stop.is_set():
+                key = letters[i % len(letters)]
+                api.on_key_press(key)
+                # Roll over: the previous key is still held when the next goes down
+                if i:
+                    api.on_key_release(letters[(i - 1) % len(letters)])
+                typed[0] += 1
+                i += 1
+                time.sleep(interval)
+
+        typist = threading.Thread(target=type_heavily, daemon=True)
+        press_ms = []
+        release_ms = []
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            typist.start()
+            try:
+                for _ in range(iterations):
+                    for pressed, samples in ((True, press_ms), (False, release_ms)):
+                        expected = server.frame_count() + 1
+                        start_ns = time.perf_counter_ns()
+                        api.on_click(0, 0, mouse.Button.x2, pressed)
+                        if not server.wait_for_frames(expected):
+                            raise RuntimeError("Timed out waiting for SET_VOICE_SETTINGS frame")
+                        received_ns, payload = server.frames[expected - 1]
+                        if payload['args'] != {'mute': not pressed}:
+                            raise RuntimeError(f"Unexpected frame {payload['args']}")
+                        samples.append((received_ns - start_ns) / 1e6)
+                        time.sleep(0.005)  # Let some typing land between edges
+            finally:
+                stop.set()
+                typist.join(timeout=1)
+
+    press_ms.sort()
+    release_ms.sort()
+    return {
+        'iterations': iterations,
+        'typing_rate': typing_rate,
+        'typed': typed[0],
+        'dropped': api.input_ring.dropped,
+        'press_p50_ms': percentile(press_ms, 0.50),
+        'press_p99_ms': percentile(press_ms, 0.99),
+        'press_max_ms': press_ms[-1],
+        'release_p99_ms': percentile(release_ms, 0.99),
+    }
+
+
+def bench_thread_count(events=500):
+    """Burst key/mouse presses during binding and check no threads pile up"""
+    api = bench_api()
+    keys = [keyboard.KeyCode.from_char(c) for c in 'abcdefghijklmnopqrstuvwxyz']
+
+    def burst(count):
+        for i in range(count):
+            api.binding_target = 'mute'
+            key = keys[i % len(keys)]
+            api.on_key_press(key)
+            api.on_click(0, 0, mouse.Button.x1, True)
+            api.on_click(0, 0, mouse.Button.x1, False)
+            api.on_key_release(key)
+            api.input_ring.wait_idle(5)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        burst(1)  # warm up: starts the shared scheduler thread
+        before = threading.active_count()
+        peak = before
+        for _ in range(10):
+            burst(events // 10)
+            peak = max(peak, threading.active_count())
+        after = threading.active_count()
+
+    api.scheduler.stop()
+    return {'events': events, 'before': before, 'peak': peak, 'after': after}
+
+
+def bench_hook_callbacks(events=100000):
+    """Wall time spent inside the hook callbacks (what the OS hook thread pays)"""
+    api = bench_api({'btn_mute': 'F9'})
+    keys = [keyboard.KeyCode.from_char(c) for c in 'abcdefghijklmnopqrstuvwxyz']
+    timings = []
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        perf = time.perf_counter_ns
+        for i in range(events):
+            key = keys[i % len(keys)]
+            start = perf()
+            api.on_key_press(key)
+            mid = perf()
+            api.on_key_release(key)
+            end = perf()
+            timings.append(mid - start)
+            timings.append(end - mid)
+        api.input_ring.wait_idle(30)
+
+    timings.sort()
+    stats = api.get_input_stats()
+    api.input_ring.close()
+    return {
+        'callbacks': len(timings),
+        'p50_ns': percentile(timings, 0.50),
+        'p99_ns': percentile(timings, 0.99),
+        'max_ns': timings[-1],
+        'dropped': stats['dropped'],
+        'capacity': stats['capacity'],
+    }
+
+
+def bench_frame_encoding(iterations=200000):
+    """Per-frame cost: dict + json.dumps + concat vs. VoiceFrameBuilder templates"""
+
+    def legacy_frame():
+        # The pre-VoiceFrameBuilder path
+        payload = {
+            'cmd': 'SET_VOICE_SETTINGS',
+            'args': {'mute': True},
+            'nonce': str(time.time())
+        }
+        encoded = json.dumps(payload).encode('utf-8')
+        header = struct.pack('<II', 1, len(encoded))
+        return header + encoded
+
+    builder = VoiceFrameBuilder()
+    buf = bytearray(256)
+
+    def template_frame():
+        # What RpcSender does per frame, including the snapshot for the transport
+        length = builder.build_voice_into(buf, 'mute', True, builder.next_nonce())
+        return bytes(memoryview(buf)[:length])
+
+    # Same wire format: header + JSON body
+    frame = template_frame()
+    op, length = struct.unpack_from('<II', frame)
+    body = json.loads(frame[8:])
+    assert op == 1 and length == len(frame) - 8
+    assert body['cmd'] == 'SET_VOICE_SETTINGS' and body['args'] == {'mute': True}
+
+    legacy = min(timeit.repeat(legacy_frame, number=iterations, repeat=3)) / iterations
+    template = min(timeit.repeat(template_frame, number=iterations, repeat=3)) / iterations
+    return {
+        'iterations': iterations,
+        'legacy_ns': legacy * 1e9,
+        'template_ns': template * 1e9,
+    }
+
+
+def bench_key_names(iterations=200000):
+    """Per-event key normalization: str() + replace + dict literals vs. the interned cache"""
+
+    def legacy_normalize(key_str):
+        # The pre-cache _normalize_key, dict literals rebuilt on every call
+        clean = key_str.replace("Key.", "").replace("'", "")
+        normalizations = {
+            'ctrl_l': 'Ctrl', 'ctrl_r': 'Ctrl', 'ctrl': 'Ctrl',
+            'shift_l': 'Shift', 'shift_r': 'Shift', 'shift': 'Shift',
+            'alt_l': 'Alt', 'alt_r': 'Alt', 'alt': 'Alt', 'alt_gr': 'Alt',
+            'cmd': 'Win', 'cmd_l': 'Win', 'cmd_r': 'Win',
+            'space': 'Space', 'enter': 'Enter', 'esc': 'Esc',
+            'tab': 'Tab', 'backspace': 'Backspace',
+            'up': '↑', 'down': '↓', 'left': '←', 'right': '→',
+            'f1': 'F1', 'f2': 'F2', 'f3': 'F3', 'f4': 'F4',
+            'f5': 'F5', 'f6': 'F6', 'f7': 'F7', 'f8': 'F8',
+            'f9': 'F9', 'f10': 'F10', 'f11': 'F11', 'f12': 'F12',
+        }
+        lower_clean = clean.lower()
+        if lower_clean in normalizations:
+            return normalizations[lower_clean]
+        if 'Button.' in key_str:
+            button_name = key_str.replace('Button.', '')
+            button_map = {'left': 'LMB', 'right': 'RMB', 'middle': 'MMB',
+                          'x1': 'Mouse4', 'x2': 'Mouse5'}
+            return button_map.get(button_name, button_name)
+        if len(clean) == 1:
+            return clean.upper()
+        return clean
+
+    api = bench_api()
+    # A typing-heavy mix: letters plus the odd modifier, space and click.
+    # KeyCodes carry a vk and a char, like the ones the OS hooks deliver.
+    events = [keyboard.KeyCode(vk=ord(c.upper()), char=c) for c in 'thequickbrownfoxjumps']
+    events += [keyboard.Key.shift, keyboard.Key.space, keyboard.Key.ctrl_l, mouse.Button.left]
+
+    for key in events:
+        assert api._key_name(key) == legacy_normalize(str(key)), key
+    # The same VK under Shift names a different char: the first one seen must not stick
+    for char in ('<', ','):
+        key = keyboard.KeyCode(vk=0xBC, char=char)  # VK_OEM_COMMA
+        assert api._key_name(key) == legacy_normalize(str(key)), key
+
+    def legacy():
+        for key in events:
+            legacy_normalize(str(key))
+
+    def cached():
+        for key in events:
+            api._key_name(key)
+
+    rounds = max(1, iterations // len(events))
+    per_event = rounds * len(events)
+    legacy_s = min(timeit.repeat(legacy, number=rounds, repeat=3)) / per_event
+    cached_s = min(timeit.repeat(cached, number=rounds, repeat=3)) / per_event
+    return {
+        'events': per_event,
+        'legacy_ns': legacy_s * 1e9,
+        'cached_ns': cached_s * 1e9,
+    }
+
+
+TYPING_TEXT = "the quick brown fox jumps over the lazy dog while typing very fast "
+
+
+def write_typing_trace(path, keys=20000, chord_every=50, interval_ms=40, hold_ms=60):
+    """Synthetic heavy-typing trace with a Ctrl+M chord every chord_every keys; returns the chord count"""
+    source, chords = SyntheticInputSource.typing(
+        TYPING_TEXT, keys, [keyboard.Key.ctrl_l, keyboard.KeyCode.from_char('m')],
+        chord_every, interval_ms, hold_ms)
+    writer = InputTraceWriter(path)
+    try:
+        for t_ns, kind, key in source.events:
+            writer.record(kind, key, t_ns)
+    finally:
+        writer.close()
+    return chords
+
+
+# Replay fixtures: timing-dependent behaviour the dispatcher must keep.
+# script: 'ms +Key' / 'ms -Key' (press / release), times from the first event.
+# Defaults: combo_timeout 0.5 s, long_press_threshold 0.8 s.
+REPLAY_FIXTURES = [
+    {'name': 'chord Ctrl+M',
+     'config': {'btn_mute': 'Ctrl+M'},
+     'script': '0 +Ctrl, 50 +M, 100 -M, 150 -Ctrl',
+     'triggered': ['mute']},
+    {'name': 'long press binds a combo',
+     'config': {}, 'bind': 'mute',
+     'script': '0 +Mouse5, 1000 +M, 1100 -M, 1200 -Mouse5',
+     'bound': 'Mouse5+M'},
+    {'name': 'short press binds the first key',
+     'config': {}, 'bind': 'mute',
+     'script': '0 +Mouse5, 300 +M, 400 -M, 500 -Mouse5',
+     'bound': 'Mouse5'},
+    {'name': 'sequence within combo_timeout',
+     'config': {'bindings': {'deafen': ['Mouse5, M']}},
+     'script': '0 +Mouse5, 50 -Mouse5, 400 +M, 450 -M',
+     'triggered': ['deafen']},
+    {'name': 'sequence past combo_timeout',
+     'config': {'bindings': {'deafen': ['Mouse5, M']}},
+     'script': '0 +Mouse5, 50 -Mouse5, 700 +M, 750 -M',
+     'triggered': []},
+    {'name': "modifier leader 'Ctrl+K, C'",
+     'config': {'bindings': {'deafen': ['Ctrl+K, C']}},
+     # Ctrl let go after K, then before K
+     'script': ('0 +Ctrl, 50 +K, 100 -K, 150 -Ctrl, 300 +C, 350 -C, '
+                '2000 +Ctrl, 2050 +K, 2100 -Ctrl, 2150 -K, 2300 +C, 2350 -C'),
+     'triggered': ['deafen', 'deafen']},
+]
+
+FIXTURE_KEYS = {'Ctrl': keyboard.Key.ctrl_l, 'Mouse4': mouse.Button.x1, 'Mouse5': mouse.Button.x2}
+
+
+def write_fixture_trace(path, script):
+    writer = InputTraceWriter(path)
+    try:
+        for step in script.split(','):
+            ms, action = step.split()
+            name = action[1:]
+            key = FIXTURE_KEYS.get(name) or keyboard.KeyCode.from_char(name.lower())
+            pressed = action[0] == '+'
+            if isinstance(key, mouse.Button):
+                kind = InputEventRing.MOUSE_PRESS if pressed else InputEventRing.MOUSE_RELEASE
+            else:
+                kind = InputEventRing.KEY_PRESS if pressed else InputEventRing.KEY_RELEASE
+            writer.record(kind, key, int(ms) * 1_000_000)
+    finally:
+        writer.close()
+
+
+def replay_fixtures(speed=0.0):
+    """Replay every REPLAY_FIXTURES script; returns [(name, ok, got, want)]"""
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='dmr-fixture-')
+    trace = os.path.join(tmpdir, 'fixture.dmrt')
+    try:
+        for fixture in REPLAY_FIXTURES:
+            write_fixture_trace(trace, fixture['script'])
+            api = bench_api(fixture['config'])
+            triggered = []
+            saved = []
+            api.trigger_action = triggered.append
+            api.save_config = lambda data=None: saved.append(data or {})
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                if fixture.get('bind'):
+                    api.start_binding(fixture['bind'])
+                replay_input_trace(api, trace, speed)
+            api.scheduler.stop()
+            if 'bound' in fixture:
+                got = saved[-1].get(f"btn_{fixture['bind']}") if saved else None
+                want = fixture['bound']
+            else:
+                got, want = triggered, fixture['triggered']
+            results.append((fixture['name'], got == want, got, want))
+            os.remove(trace)
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(trace)
+        os.rmdir(tmpdir)
+    return results
+
+
+def bench_replay(trace=None, speed=0.0, keys=20000):
+    """Replay a trace (or a synthetic heavy-typing one) through the dispatcher"""
+    expected = None
+    tmpdir = None
+    if trace is None:
+        tmpdir = tempfile.mkdtemp(prefix='dmr-trace-')
+        trace = os.path.join(tmpdir, 'typing.dmrt')
+        expected = write_typing_trace(trace, keys)
+
+    api = bench_api({'btn_mute': 'Ctrl+M'})
+    triggered = []
+    api.trigger_action = triggered.append  # count matches, don't talk to Discord
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = replay_input_trace(api, trace, speed)
+    finally:
+        if tmpdir:
+            os.remove(trace)
+            os.rmdir(tmpdir)
+
+    result.update({
+        'trace': 'synthetic heavy typing' if expected is not None else trace,
+        'fixtures': replay_fixtures(speed),
+        'speed': speed,
+        'events_per_sec': result['events'] / result['elapsed_s'],
+        'triggered': len(triggered),
+        'expected': expected,
+    })
+    return result
+
+
+def bench_load(keys=20000, speed=0.0):
+    """Synthetic typing with a Ctrl+M toggle every 50 keys through the whole pipeline to a fake Discord"""
+    source, chords = SyntheticInputSource.typing(
+        TYPING_TEXT, keys, [keyboard.Key.ctrl_l, keyboard.KeyCode.from_char('m')], speed=speed)
+    with fake_discord() as server, connected_api(server) as api:
+        api._update_config({'btn_mute': 'Ctrl+M'})
+        sender = api.rpc_sender
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start_ns = time.perf_counter_ns()
+            api.start_input(source)
+            source.join()
+            # Every toggle written, merged into a queued frame or rejected, and answered
+            deadline = time.monotonic() + 30
+            while sender.depth() or api.voice_state.pending_count():
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Timed out waiting for the last toggles")
+                time.sleep(0.0005)
+            elapsed_ns = time.perf_counter_ns() - start_ns
+            api.stop_input()
+
+    return {
+        'events': source.fed,
+        'speed': speed,
+        'events_per_sec': source.fed / (elapsed_ns / 1e9),
+        'prefiltered': api.prefiltered,
+        'dropped': api.input_ring.dropped,
+        'chords': chords,
+        'frames': sender.sent,
+        'merged': sender.merged,
+        'rejected': sender.rejected,
+        'muted': server.voice['mute'],
+        'expected_muted': chords % 2 == 1,
+    }
+
+
+def bench_reconnect(cycles=5, downtime=0.37):
+    """Discord going away and coming back: time from restart to subscribed again"""
+    with fake_discord() as server:
+        api = bench_api()
+        api.saved_access_token = 'benchmark-token'  # fast path: AUTHENTICATE only
+
+        def wait_connects(count, timeout=10):
+            deadline = time.monotonic() + timeout
+            while api.rpc_metrics['connects'] < count:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Timed out waiting for the RPC connection")
+                time.sleep(0.001)
+
+        results = []
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            api.connect('0', 'benchmark-secret')
+            wait_connects(1)
+            for cycle in range(cycles):
+                server.stop()
+                time.sleep(downtime)
+                restarted_at = time.monotonic()
+                server = FakeDiscordIPC(server.path)
+                server.start()
+                wait_connects(cycle + 2)
+                results.append(time.monotonic() - restarted_at)
+            api.disconnect()
+        server.stop()
+
+    results.sort()
+    return {
+        'cycles': cycles,
+        'downtime_s': downtime,
+        'p50_ms': percentile(results, 0.5) * 1000,
+        'max_ms': results[-1] * 1000,
+        'last_reconnect_s': api.rpc_metrics['last_reconnect_s'],
+    }
+
+
+STARTUP_BUDGET_MS = 400  # process spawn -> OS hooks installed, --minimized launch
+
+
+def parse_importtime(stderr):
+    """Top-level imports from `-X importtime` output as (cumulative_us, name)"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.startswith(' ') and not name.startswith('  '):  # not nested
+            imports.append((int(cumulative), name.strip()))
+    imports.sort(reverse=True)
+    return imports
+
+
+def bench_startup(runs=5, budget_ms=STARTUP_BUDGET_MS):
+    """Cold start: process spawn -> OS hooks installed, with per-import cost"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discord_mouse_rpc.py')
+    spawn_to_hook = []
+    imports = []
+    lazy_loaded = []
+
+    for _ in range(runs):
+        start = time.time()
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', script, '--startup-report'],
+            capture_output=True, text=True, timeout=60
+        )
+        line = next((l for l in proc.stdout.splitlines() if l.startswith('STARTUP ')), None)
+        if line is None:
+            raise RuntimeError(f"--startup-report produced no report:\n{proc.stdout}{proc.stderr}")
+        report = json.loads(line[len('STARTUP '):])
+        spawn_to_hook.append((report['first_hook_unix'] - start) * 1000)
+        lazy_loaded = report['lazy_modules_loaded']
+        imports = parse_importtime(proc.stderr)
+
+    spawn_to_hook.sort()
+    return {
+        'runs': runs,
+        'budget_ms': budget_ms,
+        'p50_ms': percentile(spawn_to_hook, 0.5),
+        'max_ms': spawn_to_hook[-1],
+        'lazy_modules_loaded': lazy_loaded,
+        'top_imports': imports[:10],
+    }
+
+
+def process_rss(pid):
+    """Resident set size in bytes of pid plus its children (WebView2 helpers)"""
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+        return sum(p.memory_info().rss for p in procs)
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    raise RuntimeError("Measuring RSS needs psutil (pip install psutil) or Linux /proc")
+
+
+def bench_memory(settle=5.0):
+    """RSS after startup: --headless vs the windowed (WebView) app"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discord_mouse_rpc.py')
+    modes = {'headless': ['--headless'], 'windowed': []}
+    result = {'settle_s': settle}
+
+    for mode, flags in modes.items():
+        proc = subprocess.Popen([sys.executable, script] + flags,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(settle)
+            result[mode] = process_rss(proc.pid) if proc.poll() is None else None
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+    return result
+
+
+def print_latency_report(result):
+    print(f"Input -> IPC latency ({result['input']}, {result['iterations']} toggles)")
+    print(f"  p50: {result['p50_us']:10.1f} us")
+    print(f"  p99: {result['p99_us']:10.1f} us")
+    print(f"  max: {result['max_us']:10.1f} us")
+    print(f"  throughput: {result['toggles_per_sec']:,.0f} toggles/sec "
+          f"({result['frames_written']} frames after merging, {result['dropped']} dropped)")
+    if result['stages']:
+        print("  per stage (bucketed):        count    p50 us    p99 us    max us")
+        for stage, stats in result['stages'].items():
+            print(f"    {stage:10s} {stats['count']:18d} {stats['p50_us']:9.1f} "
+                  f"{stats['p99_us']:9.1f} {stats['max_us']:9.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Discord Mouse Controller benchmarks")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    latency = sub.add_parser('latency', help="input -> IPC frame latency against a fake Discord")
+    latency.add_argument('--iterations', type=int, default=1000)
+    latency.add_argument('--throughput-toggles', type=int, default=1000)
+    latency.add_argument('--input', choices=('mouse', 'keyboard'), default='mouse')
+    latency.add_argument('--stages', action='store_true', help="also report per-stage histograms")
+
+    hold = sub.add_parser('hold', help="push-to-talk press -> frame latency under heavy typing")
+    hold.add_argument('--iterations', type=int, default=200)
+    hold.add_argument('--typing-rate', type=int, default=500, help="key presses per second")
+
+    threads = sub.add_parser('threads', help="thread count under a burst of binding events")
+    threads.add_argument('--events', type=int, default=500)
+
+    hook = sub.add_parser('hook', help="wall time of the OS hook callbacks")
+    hook.add_argument('--events', type=int, default=100000)
+
+    frames = sub.add_parser('frames', help="SET_VOICE_SETTINGS frame encoding microbenchmark")
+    frames.add_argument('--iterations', type=int, default=200000)
+
+    keynames = sub.add_parser('keynames', help="key normalization microbenchmark")
+    keynames.add_argument('--iterations', type=int, default=200000)
+
+    replay = sub.add_parser('replay', help="replay an input trace through the dispatcher")
+    replay.add_argument('--trace', help="trace from --record-trace (default: synthetic heavy typing)")
+    replay.add_argument('--speed', type=float, default=0.0, help="1 = recorded timing, 0 = back to back")
+    replay.add_argument('--keys', type=int, default=20000, help="synthetic trace length")
+
+    load = sub.add_parser('load', help="synthetic input source through the whole pipeline to a fake Discord")
+    load.add_argument('--keys', type=int, default=20000)
+    load.add_argument('--speed', type=float, default=0.0, help="1 = real typing speed, 0 = back to back")
+
+    reconnect = sub.add_parser('reconnect', help="time to reconnect after Discord restarts")
+    reconnect.add_argument('--cycles', type=int, default=5)
+    reconnect.add_argument('--downtime', type=float, default=0.37)
+
+    startup = sub.add_parser('startup', help="spawn -> hooks installed time, checked against a budget")
+    startup.add_argument('--runs', type=int, default=5)
+    startup.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS)
+
+    memory = sub.add_parser('memory', help="RSS of --headless vs the windowed app")
+    memory.add_argument('--settle', type=float, default=5.0)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'latency':
+        if not hasattr(socket, 'AF_UNIX'):
+            print("The latency benchmark needs Unix sockets (Linux / macOS)")
+            return 1
+        print_latency_report(bench_latency(args.iterations, args.throughput_toggles, args.input, args.stages))
+    elif args.command == 'hold':
+        if not hasattr(socket, 'AF_UNIX'):
+            print("The hold benchmark needs Unix sockets (Linux / macOS)")
+            return 1
+        result = bench_hold_latency(args.iterations, args.typing_rate)
+        print(f"Push-to-talk press -> frame ({result['iterations']} holds, typing at "
+              f"{result['typing_rate']} keys/sec, {result['typed']} keys typed, {result['dropped']} dropped)")
+        print(f"  press p50:   {result['press_p50_ms']:8.3f} ms")
+        print(f"  press p99:   {result['press_p99_ms']:8.3f} ms")
+        print(f"  press max:   {result['press_max_ms']:8.3f} ms")
+        print(f"  release p99: {result['release_p99_ms']:8.3f} ms")
+        if result['press_p99_ms'] > HOLD_BUDGET_MS:
+            print(f"FAIL: press p99 over {HOLD_BUDGET_MS} ms")
+            return 1
+    elif args.command == 'threads':
+        result = bench_thread_count(args.events)
+        print(f"Threads during {result['events']} binding events: "
+              f"before={result['before']} peak={result['peak']} after={result['after']}")
+        if result['peak'] != result['before']:
+            print("FAIL: thread count grew under the burst")
+            return 1
+    elif args.command == 'hook':
+        result = bench_hook_callbacks(args.events)
+        print(f"Hook callback wall time ({result['callbacks']} callbacks)")
+        print(f"  p50: {result['p50_ns']:8d} ns")
+        print(f"  p99: {result['p99_ns']:8d} ns")
+        print(f"  max: {result['max_ns']:8d} ns")
+        print(f"  dropped: {result['dropped']} (ring capacity {result['capacity']})")
+    elif args.command == 'reconnect':
+        if not hasattr(socket, 'AF_UNIX'):
+            print("The reconnect benchmark needs Unix sockets (Linux / macOS)")
+            return 1
+        result = bench_reconnect(args.cycles, args.downtime)
+        print(f"Reconnect after Discord restart ({result['cycles']} cycles, "
+              f"{result['downtime_s']:.2f}s downtime)")
+        print(f"  endpoint back -> subscribed p50: {result['p50_ms']:8.1f} ms")
+        print(f"  endpoint back -> subscribed max: {result['max_ms']:8.1f} ms")
+        print(f"  last reconnect (incl. downtime): {result['last_reconnect_s']:.3f} s")
+    elif args.command == 'frames':
+        result = bench_frame_encoding(args.iterations)
+        print(f"SET_VOICE_SETTINGS frame encoding ({result['iterations']} frames)")
+        print(f"  json.dumps path: {result['legacy_ns']:8.0f} ns/frame")
+        print(f"  template path:   {result['template_ns']:8.0f} ns/frame "
+              f"({result['legacy_ns'] / result['template_ns']:.1f}x)")
+    elif args.command == 'keynames':
+        result = bench_key_names(args.iterations)
+        print(f"Key normalization ({result['events']} events)")
+        print(f"  str() + _normalize_key: {result['legacy_ns']:8.0f} ns/event")
+        print(f"  interned cache:         {result['cached_ns']:8.0f} ns/event "
+              f"({result['legacy_ns'] / result['cached_ns']:.1f}x)")
+    elif args.command == 'replay':
+        result = bench_replay(args.trace, args.speed, args.keys)
+        print(f"Trace replay ({result['trace']}, {result['events']} events, speed {result['speed']:g})")
+        print(f"  elapsed:    {result['elapsed_s']:8.3f} s ({result['events_per_sec']:,.0f} events/sec)")
+        print(f"  dropped:    {result['dropped']}")
+        print(f"  prefiltered: {result['prefiltered']} (never reached the dispatcher)")
+        print(f"  triggered:  {result['triggered']}"
+              + (f" (expected {result['expected']})" if result['expected'] is not None else ""))
+        if result['expected'] is not None and result['triggered'] != result['expected']:
+            print("FAIL: bindings did not fire exactly once per chord")
+            return 1
+        print("  timing fixtures:")
+        failed = 0
+        for name, ok, got, want in result['fixtures']:
+            print(f"    {'ok  ' if ok else 'FAIL'} {name}" + ("" if ok else f": got {got!r}, expected {want!r}"))
+            failed += not ok
+        if failed:
+            print(f"FAIL: {failed} timing fixture(s) replayed differently")
+            return 1
+    elif args.command == 'load':
+        if not hasattr(socket, 'AF_UNIX'):
+            print("The load benchmark needs Unix sockets (Linux / macOS)")
+            return 1
+        result = bench_load(args.keys, args.speed)
+        print(f"Synthetic load ({result['events']} events, speed {result['speed']:g})")
+        print(f"  throughput:  {result['events_per_sec']:,.0f} events/sec")
+        print(f"  prefiltered: {result['prefiltered']}  dropped: {result['dropped']}")
+        print(f"  toggles:     {result['chords']} -> {result['frames']} frames "
+              f"({result['merged']} merged, {result['rejected']} rejected)")
+        print(f"  final mute:  {result['muted']} (expected {result['expected_muted']})")
+        if result['dropped'] or result['rejected'] or result['muted'] != result['expected_muted']:
+            print("FAIL: toggles were lost between the input source and Discord")
+            return 1
+    elif args.command == 'startup':
+        result = bench_startup(args.runs, args.budget_ms)
+        print(f"Startup to first hook ({result['runs']} runs, budget {result['budget_ms']:.0f} ms)")
+        print(f"  p50: {result['p50_ms']:8.1f} ms")
+        print(f"  max: {result['max_ms']:8.1f} ms")
+        print("  heaviest imports (cumulative):")
+        for cumulative_us, name in result['top_imports']:
+            print(f"    {cumulative_us / 1000:8.1f} ms  {name}")
+        if result['lazy_modules_loaded']:
+            print(f"FAIL: loaded before the hooks: {', '.join(result['lazy_modules_loaded'])}")
+            return 1
+        if result['p50_ms'] > result['budget_ms']:
+            print("FAIL: time to first hook is over budget")
+            return 1
+    elif args.command == 'memory':
+        result = bench_memory(args.settle)
+        print(f"RSS after {result['settle_s']:.1f}s (process + children)")
+        for mode in ('headless', 'windowed'):
+            rss = result[mode]
+            print(f"  {mode:9s} " + (f"{rss / 2**20:8.1f} MiB" if rss else "   (exited before measuring)"))
+        if result['headless'] and result['windowed']:
+            print(f"  headless saves {(result['windowed'] - result['headless']) / 2**20:.1f} MiB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
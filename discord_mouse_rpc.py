@@ -3,22 +3,29 @@ Discord Mouse Controller - Web UI Version
 使用 PyWebView 提供精美的 Glassmorphism 介面
 """
 
-import webview
+import time
+_IMPORT_START = time.perf_counter()  # Baseline for --startup-report
+
+import abc
 import threading
 import asyncio
-from pypresence import AioClient
+import heapq
+import bisect
+import itertools
+import collections
+import concurrent.futures
+import random
 from pynput import mouse, keyboard
-import time
 import json
 import os
-import requests
 import struct
-import pystray
-from PIL import Image, ImageDraw
-import winreg
 import sys
 import ctypes
 
+# webview, pystray, PIL, requests and winreg are imported where first used so
+# a --minimized login launch gets its hooks installed without paying for them
+LAZY_MODULES = ('webview', 'pystray', 'PIL', 'requests', 'winreg')
+
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
     try:
@@ -43,69 +50,2031 @@ def get_config_path():
 CONFIG_FILE = get_config_path()
 HTML_FILE = resource_path(os.path.join("web", "index.html"))
 
+# Overridable (env or config 'oauth_token_url') so tests can use a local stand-in
+OAUTH_TOKEN_URL = os.environ.get('DISCORD_OAUTH_TOKEN_URL', 'https://discord.com/api/oauth2/token')
+OAUTH_REDIRECT_URI = 'http://127.0.0.1'
+
+def get_cache_dir():
+    """Per-user cache directory, kept out of the install / source directory"""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), 'AppData', 'Local')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, "discord-mic-toggle")
+
+# Pre-rendered tray icons; bump the version when TraySprites.render changes
+TRAY_CACHE_DIR = os.path.join(get_cache_dir(), "tray")
+TRAY_SPRITE_VERSION = 1
+
+
+class AppConfig:
+    """Validated, immutable snapshot of config.json; changes publish a new one"""
+    __slots__ = ('client_id', 'client_secret', 'minimize_to_tray', 'show_last_input',
+                 'access_token', 'refresh_token', 'token_expires_at', 'token_refresh_at',
+                 'oauth_token_url', 'combo_timeout', 'long_press_threshold',
+                 'buttons', 'bindings', 'macros', 'extras')
+
+    DEFAULTS = {
+        'client_id': None,
+        'client_secret': None,
+        'minimize_to_tray': False,
+        'show_last_input': False,
+        'access_token': None,
+        'refresh_token': None,
+        'token_expires_at': None,
+        'token_refresh_at': None,
+        'oauth_token_url': None,
+        'combo_timeout': 0.5,
+        'long_press_threshold': 0.8,
+    }
+    # Inclusive bounds for the numeric timing settings (seconds)
+    RANGES = {
+        'combo_timeout': (0.05, 5.0),
+        'long_press_threshold': (0.1, 10.0),
+    }
+
+    def __init__(self, **fields):
+        for name in self.DEFAULTS:
+            object.__setattr__(self, name, fields.get(name, self.DEFAULTS[name]))
+        for name in ('buttons', 'bindings', 'macros', 'extras'):
+            object.__setattr__(self, name, fields.get(name) or {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("AppConfig is immutable; publish a new snapshot instead")
+
+    @classmethod
+    def from_dict(cls, data):
+        """Validate a raw config dict. Returns (AppConfig, [problem, ...])"""
+        problems = []
+        if not isinstance(data, dict):
+            return cls(), ["config is not a JSON object"]
+
+        fields = {}
+        buttons = {}
+        bindings = {}
+        macros = {}
+        extras = {}
+        for name, value in data.items():
+            if name in ('client_id', 'client_secret', 'access_token', 'refresh_token', 'oauth_token_url'):
+                if value is None or isinstance(value, str):
+                    fields[name] = value
+                elif isinstance(value, int) and not isinstance(value, bool) and name != 'oauth_token_url':
+                    fields[name] = str(value)  # Discord IDs are numeric
+                else:
+                    extras[name] = value
+                    problems.append(f"{name}: expected a string")
+            elif name in ('minimize_to_tray', 'show_last_input'):
+                if isinstance(value, bool):
+                    fields[name] = value
+                else:
+                    extras[name] = value
+                    problems.append(f"{name}: expected true/false")
+            elif name in ('token_expires_at', 'token_refresh_at'):
+                if value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)):
+                    fields[name] = value
+                else:
+                    extras[name] = value
+                    problems.append(f"{name}: expected a number")
+            elif name in cls.RANGES:
+                low, high = cls.RANGES[name]
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and low <= value <= high:
+                    fields[name] = float(value)
+                else:
+                    extras[name] = value
+                    problems.append(f"{name}: expected a number between {low} and {high}")
+            elif name.startswith('btn_'):
+                if value is None or isinstance(value, str):
+                    buttons[name[4:]] = value
+                else:
+                    extras[name] = value
+                    problems.append(f"{name}: expected a key name")
+            elif name == 'bindings':
+                if not isinstance(value, dict):
+                    extras[name] = value
+                    problems.append("bindings: expected an object of action -> [chords]")
+                    continue
+                for action, chords in value.items():
+                    if isinstance(chords, str):
+                        chords = [chords]
+                    if not isinstance(chords, list) or not all(isinstance(c, str) for c in chords):
+                        extras[name] = value  # Round-trips as written
+                        problems.append(f"bindings.{action}: expected a list of key names")
+                        continue
+                    bindings[action] = tuple(chords)
+            elif name == 'macros':
+                extras[name] = value  # Round-trips as written; compiled below
+                if not isinstance(value, dict):
+                    problems.append("macros: expected an object of name -> [steps]")
+                    continue
+                for macro, steps in value.items():
+                    try:
+                        if not isinstance(steps, list) or not steps:
+                            raise ValueError("expected a non-empty list of steps")
+                        macros[macro] = tuple(cls.parse_macro_step(step) for step in steps)
+                    except ValueError as e:
+                        problems.append(f"macros.{macro}: {e}")
+            else:
+                extras[name] = value  # Unknown keys round-trip untouched
+
+        return cls(buttons=buttons, bindings=bindings, macros=macros, extras=extras, **fields), problems
+
+    # Macro step names for the two Discord voice fields
+    MACRO_VOICE_FIELDS = {'mute': 'mute', 'deafen': 'deaf'}
+
+    @classmethod
+    def parse_macro_step(cls, step):
+        """Compile one macro step string ('mute:on', 'wait:200', ...) into a step tuple"""
+        if not isinstance(step, str):
+            raise ValueError(f"step {step!r} is not a string")
+        name, _, arg = step.strip().lower().partition(':')
+        if name in ('unmute', 'undeafen') and not arg:
+            return ('voice', cls.MACRO_VOICE_FIELDS[name[2:]], False)
+        if name in cls.MACRO_VOICE_FIELDS:
+            values = {'': None, 'toggle': None, 'on': True, 'off': False}
+            if arg not in values:
+                raise ValueError(f"step {step!r}: expected on, off or toggle")
+            return ('voice', cls.MACRO_VOICE_FIELDS[name], values[arg])
+        if name == 'media' and not arg:
+            return ('media',)
+        if name == 'wait':
+            try:
+                ms = float(arg)
+            except ValueError:
+                raise ValueError(f"step {step!r}: expected wait:<milliseconds>") from None
+            if not 0 <= ms <= 60000:
+                raise ValueError(f"step {step!r}: wait must be 0-60000 ms")
+            return ('wait', ms / 1000)
+        raise ValueError(f"unknown step {step!r}")
+
+    def to_dict(self):
+        data = dict(self.extras)  # Includes ignored values, as written
+        for name in self.DEFAULTS:
+            if name not in data:
+                data[name] = getattr(self, name)
+        for action, chord in self.buttons.items():
+            data[f'btn_{action}'] = chord
+        if self.bindings and 'bindings' not in data:
+            data['bindings'] = {action: list(chords) for action, chords in self.bindings.items()}
+        return data
+
+
+class ConfigWriter:
+    """Debounced, atomic write-behind persistence for config.json"""
+
+    def __init__(self, path, delay=0.5, max_delay=2.0):
+        self.path = path
+        self.delay = delay  # Quiet period before writing
+        self.max_delay = max_delay  # Upper bound while changes keep coming
+        self._cond = threading.Condition()
+        # Held across take-snapshot + write, so flush() and the writer thread
+        # never share the .tmp file and a newer snapshot is never replaced
+        # by an older one. Always taken before _cond, never inside it.
+        self._write_lock = threading.Lock()
+        self._pending = None  # Serialized JSON waiting to be written
+        self._first_change = None
+        self._deadline = None
+        self._thread = None
+        self.last_mtime_ns = None  # mtime of our own last write, so the watcher can skip it
+        self.writes = 0
+        self.coalesced = 0
+
+    @property
+    def pending(self):
+        return self._pending is not None
+
+    def schedule(self, config):
+        data = json.dumps(config)  # Snapshot now; later mutations don't leak in
+        with self._cond:
+            now = time.monotonic()
+            if self._pending is None:
+                self._first_change = now
+            else:
+                self.coalesced += 1
+            self._pending = data
+            self._deadline = min(now + self.delay, self._first_change + self.max_delay)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ConfigWriter", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def flush(self):
+        """Write anything pending now; waits for a write already in progress"""
+        self._write_pending()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None or time.monotonic() < self._deadline:
+                    if self._pending is None:
+                        self._cond.wait()
+                    else:
+                        self._cond.wait(self._deadline - time.monotonic())
+            self._write_pending()
+
+    def _write_pending(self):
+        with self._write_lock:
+            with self._cond:
+                data, self._pending = self._pending, None
+            if data is None:  # flush() got there first
+                return
+            if not self._write(data):
+                with self._cond:
+                    # Retry later (e.g. another process holds config.json),
+                    # unless a newer snapshot has already replaced this one
+                    if self._pending is None:
+                        now = time.monotonic()
+                        self._pending = data
+                        self._first_change = now
+                        self._deadline = now + self.max_delay
+                        self._cond.notify()
+
+    def _write(self, data):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.last_mtime_ns = os.stat(self.path).st_mtime_ns
+            self.writes += 1
+            return True
+        except OSError as e:
+            print(f"[ERROR] Failed to save config (will retry): {e}")
+            return False
+
+
+class TimerHandle:
+    """A scheduled callback that can be cancelled before it fires"""
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerScheduler:
+    """One background thread running cancellable timers from a heap"""
+
+    def __init__(self, name="TimerScheduler"):
+        self.name = name
+        self._heap = []  # (deadline, seq, handle)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) on the scheduler thread after delay seconds"""
+        handle = TimerHandle(time.monotonic() + delay, callback, args)
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, (handle.deadline, next(self._seq), handle))
+            # Only wake the thread if the earliest deadline changed
+            if self._heap[0][2] is handle:
+                self._cond.notify()
+        return handle
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._heap.clear()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    deadline, _, handle = self._heap[0]
+                    if handle.cancelled:
+                        heapq.heappop(self._heap)
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        heapq.heappop(self._heap)
+                        break
+                    self._cond.wait(remaining)
+
+            # Run outside the lock so callbacks can schedule new timers
+            try:
+                handle.callback(*handle.args)
+            except Exception as e:
+                print(f"[ERROR] Timer callback failed: {e}")
+
+
+class InputEventRing:
+    """Preallocated ring buffer from the OS hook threads to the dispatcher"""
+    KEY_PRESS = 0
+    KEY_RELEASE = 1
+    MOUSE_PRESS = 2
+    MOUSE_RELEASE = 3
+    RESYNC = 4  # key = HeldKeys snapshot the OS says is stale (see DiscordAPI._resync_held_keys)
+    LONG_PRESS = 5  # key = press time of the binding key whose long press timer fired
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self._kinds = [0] * capacity
+        self._keys = [None] * capacity
+        self._times = [0] * capacity
+        self._head = 0  # next slot to read
+        self._count = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self.pushed = 0
+        self.processed = 0
+        self.dropped = 0
+
+    def push(self, kind, key, t_ns):
+        """Called from hook threads - must stay cheap and never block for long"""
+        with self._cond:
+            if self._count == self.capacity:
+                self.dropped += 1
+                return False
+            slot = (self._head + self._count) % self.capacity
+            self._kinds[slot] = kind
+            self._keys[slot] = key
+            self._times[slot] = t_ns
+            self._count += 1
+            self.pushed += 1
+            self._cond.notify()
+        return True
+
+    def pop_all(self):
+        """Block until events are available and drain them in order; None once closed"""
+        with self._cond:
+            while not self._count:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            batch = []
+            head = self._head
+            for _ in range(self._count):
+                batch.append((self._kinds[head], self._keys[head], self._times[head]))
+                self._keys[head] = None  # don't keep key objects alive
+                head = (head + 1) % self.capacity
+            self._head = head
+            self._count = 0
+        return batch
+
+    def task_done(self, count):
+        with self._cond:
+            self.processed += count
+            self._cond.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Wait until every pushed event has been dispatched"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.processed >= self.pushed, timeout)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class HeldKeys:
+    """Keys and buttons currently held, as one (bitmask, press order) state tuple"""
+    __slots__ = ('ids', 'names', 'vks', 'state', '_vks_of')
+
+    def __init__(self, vks_of=None):
+        self.ids = {}  # name -> id
+        self.names = []  # id -> name
+        self.vks = []  # id -> OS virtual-key codes that mean "held" (may be empty)
+        # Replaced in one assignment by the dispatcher (the only writer), so
+        # other threads read a consistent snapshot without a lock
+        self.state = (0, ())
+        self._vks_of = vks_of  # (name, key) -> vk tuple, called once per name
+
+    def key_id(self, name, key=None):
+        kid = self.ids.get(name)
+        if kid is None:
+            kid = len(self.names)
+            self.names.append(name)
+            self.vks.append(self._vks_of(name, key) if self._vks_of else ())
+            self.ids[name] = kid
+        return kid
+
+    def press(self, name, key=None):
+        """Mark name as held; False if it already was (key repeat)"""
+        kid = self.key_id(name, key)
+        mask, order = self.state
+        bit = 1 << kid
+        if mask & bit:
+            return False
+        self.state = (mask | bit, order + (kid,))
+        return True
+
+    def release(self, name):
+        """Mark name as released; False if it wasn't held"""
+        kid = self.ids.get(name)
+        if kid is None:
+            return False
+        mask, order = self.state
+        bit = 1 << kid
+        if not mask & bit:
+            return False
+        self.state = (mask & ~bit, tuple(k for k in order if k != kid))
+        return True
+
+    def clear(self):
+        self.state = (0, ())
+
+    def snapshot(self):
+        """(bitmask, ids in press order) - immutable, safe to keep"""
+        return self.state
+
+    def held_names(self, state=None):
+        names = self.names
+        return [names[kid] for kid in (state or self.state)[1]]
+
+    def __contains__(self, name):
+        kid = self.ids.get(name)
+        return kid is not None and (self.state[0] >> kid) & 1 == 1
+
+    def __len__(self):
+        return len(self.state[1])
+
+    def stale(self, state, is_down):
+        """Names held in `state` that the OS reports as up (is_down(vk) -> bool)"""
+        stale = []
+        for kid in state[1]:
+            vks = self.vks[kid]
+            if vks and not any(is_down(vk) for vk in vks):
+                stale.append(self.names[kid])
+        return stale
+
+
+# === Input traces ===
+#
+# Binary, little-endian. File header: b'DMRT' + u8 version. Then records:
+#   define: u8 TRACE_DEFINE, u16 key_id, u8 key type ('k' Key / 'c' KeyCode /
+#           'b' Button), i32 vk (-1 if none), u8 length, utf-8 name or char
+#   event:  u8 TRACE_EVENT, u64 t_ns since the first event, u8 device
+#           (0 keyboard / 1 mouse), u8 pressed, u16 key_id
+# A key is defined once, before its first event.
+
+TRACE_MAGIC = b'DMRT'
+TRACE_VERSION = 1
+TRACE_DEFINE = 1
+TRACE_EVENT = 2
+_TRACE_DEFINE = struct.Struct('<BHBiB')
+_TRACE_EVENT = struct.Struct('<BQBBH')
+
+
+class InputTraceWriter:
+    """Records dispatcher input events to a compact binary trace file"""
+
+    def __init__(self, path, buffer_size=64 * 1024):
+        self.path = path
+        self.buffer_size = buffer_size
+        self._file = open(path, 'wb')
+        self._file.write(TRACE_MAGIC + bytes([TRACE_VERSION]))
+        self._buf = bytearray()
+        self._ids = {}  # Key / Button member, or (vk, char) for KeyCodes -> key_id
+        self._start_ns = None
+        self.events = 0
+
+    def record(self, kind, key, t_ns):
+        if self._start_ns is None:
+            self._start_ns = t_ns
+        ident = (key.vk, key.char) if type(key) is keyboard.KeyCode else key
+        key_id = self._ids.get(ident)
+        if key_id is None:
+            key_id = self._define(ident, key)
+        device = 1 if kind >= InputEventRing.MOUSE_PRESS else 0
+        pressed = kind in (InputEventRing.KEY_PRESS, InputEventRing.MOUSE_PRESS)
+        self._buf += _TRACE_EVENT.pack(TRACE_EVENT, t_ns - self._start_ns, device, pressed, key_id)
+        self.events += 1
+        if len(self._buf) >= self.buffer_size:
+            self._flush_buffer()
+
+    def _define(self, ident, key):
+        key_id = len(self._ids)
+        if type(key) is keyboard.KeyCode:
+            key_type, vk, name = 'c', key.vk, key.char or ''
+        elif isinstance(key, mouse.Button):
+            key_type, vk, name = 'b', None, key.name
+        else:
+            key_type, vk, name = 'k', None, key.name
+        encoded = name.encode('utf-8')
+        self._buf += _TRACE_DEFINE.pack(TRACE_DEFINE, key_id, ord(key_type),
+                                        -1 if vk is None else vk, len(encoded))
+        self._buf += encoded
+        self._ids[ident] = key_id
+        return key_id
+
+    def _flush_buffer(self):
+        self._file.write(self._buf)
+        self._buf.clear()
+
+    def close(self):
+        if not self._file.closed:
+            self._flush_buffer()
+            self._file.close()
+
+
+def read_input_trace(path):
+    """Parse a trace file into [(t_ns, kind, key), ...] with pynput key objects"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != TRACE_MAGIC or len(data) < 5:
+        raise ValueError(f"{path} is not an input trace")
+    if data[4] != TRACE_VERSION:
+        raise ValueError(f"Unsupported input trace version {data[4]}")
+    
+    keys = {}
+    events = []
+    offset = 5
+    while offset < len(data):
+        tag = data[offset]
+        if tag == TRACE_DEFINE:
+            _, key_id, key_type, vk, length = _TRACE_DEFINE.unpack_from(data, offset)
+            offset += _TRACE_DEFINE.size
+            name = data[offset:offset + length].decode('utf-8')
+            offset += length
+            if key_type == ord('c'):
+                keys[key_id] = keyboard.KeyCode(vk=None if vk < 0 else vk, char=name or None)
+            elif key_type == ord('b'):
+                keys[key_id] = mouse.Button[name]
+            else:
+                keys[key_id] = keyboard.Key[name]
+        elif tag == TRACE_EVENT:
+            _, t_ns, device, pressed, key_id = _TRACE_EVENT.unpack_from(data, offset)
+            offset += _TRACE_EVENT.size
+            if device:
+                kind = InputEventRing.MOUSE_PRESS if pressed else InputEventRing.MOUSE_RELEASE
+            else:
+                kind = InputEventRing.KEY_PRESS if pressed else InputEventRing.KEY_RELEASE
+            events.append((t_ns, kind, keys[key_id]))
+        else:
+            raise ValueError(f"Corrupt input trace at byte {offset}")
+    return events
+
+
+# === Input sources ===
+
+class InputSource(abc.ABC):
+    """Where key / button events come from"""
+
+    @abc.abstractmethod
+    def start(self, api):
+        """Begin delivering events to api's hook callbacks"""
+
+    def wait(self):
+        """Block until the source is delivering events"""
+
+    @abc.abstractmethod
+    def stop(self):
+        """Stop delivering events"""
+
+
+class PynputInputSource(InputSource):
+    """Global keyboard / mouse hooks via pynput (the real app)"""
+    # Mouse messages no binding uses: moves and wheel / tilt-wheel
+    WM_MOUSEMOVE = 0x0200
+    WM_MOUSEWHEEL = 0x020A
+    WM_MOUSEHWHEEL = 0x020E
+    IGNORED_MOUSE_MESSAGES = frozenset((WM_MOUSEMOVE, WM_MOUSEWHEEL, WM_MOUSEHWHEEL))
+
+    def __init__(self):
+        self.mouse_listener = None
+        self.keyboard_listener = None
+
+    def start(self, api):
+        options = {}
+        if sys.platform == 'win32':
+            # Runs first thing in pynput's hook callback: moves and scrolls
+            # return before pynput builds event objects or takes its locks
+            options['win32_event_filter'] = self._filter_mouse
+        self.mouse_listener = mouse.Listener(on_click=api.on_click, **options)
+        self.mouse_listener.start()
+
+        self.keyboard_listener = keyboard.Listener(
+            on_press=api.on_key_press,
+            on_release=api.on_key_release
+        )
+        self.keyboard_listener.start()
+
+    def _filter_mouse(self, msg, data):
+        # False = don't process in pynput; the event still reaches other apps
+        return msg not in self.IGNORED_MOUSE_MESSAGES
+
+    def wait(self):
+        for listener in (self.mouse_listener, self.keyboard_listener):
+            if listener:
+                listener.wait()  # Returns once the OS hook is installed
+
+    def stop(self):
+        for listener in (self.mouse_listener, self.keyboard_listener):
+            if listener:
+                listener.stop()
+
+
+class SyntheticInputSource(InputSource):
+    """Scripted input through the real prefilter and ring, without OS hooks"""
+    # Keys are still pynput objects: on Linux that needs an X display (Xvfb)
+
+    def __init__(self, events, speed=0.0):
+        self.events = events  # (t_ns, kind, key), the read_input_trace() format
+        # 1.0 keeps the timestamps, N plays N times faster; 0 feeds back to
+        # back and the api runs on the scripted timestamps (event clock)
+        self.speed = speed
+        self.fed = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def typing(cls, text, keys=20000, chord=None, chord_every=50, interval_ms=40, hold_ms=60, speed=0.0):
+        """Heavy typing of text, plus the chord every chord_every keys; returns (source, chords)"""
+        events = []
+        t_ns = 0
+        chords = 0
+        step = interval_ms * 1_000_000
+        hold = hold_ms * 1_000_000
+        pending_release = None
+        for i in range(keys):
+            if chord and i and i % chord_every == 0:
+                if pending_release is not None:
+                    events.append((t_ns, InputEventRing.KEY_RELEASE, pending_release))
+                    pending_release = None
+                for kind, key in ([(InputEventRing.KEY_PRESS, key) for key in chord]
+                                  + [(InputEventRing.KEY_RELEASE, key) for key in reversed(chord)]):
+                    t_ns += step
+                    events.append((t_ns, kind, key))
+                chords += 1
+            char = text[i % len(text)]
+            key = keyboard.Key.space if char == ' ' else keyboard.KeyCode.from_char(char)
+            t_ns += step
+            events.append((t_ns, InputEventRing.KEY_PRESS, key))
+            # Rollover: the previous key comes up after the next one went down
+            if pending_release is not None:
+                events.append((t_ns + hold - step, InputEventRing.KEY_RELEASE, pending_release))
+            pending_release = key
+        if pending_release is not None:
+            events.append((t_ns + hold, InputEventRing.KEY_RELEASE, pending_release))
+        return cls(events, speed), chords
+
+    def start(self, api):
+        self._thread = threading.Thread(target=self.run, args=(api,), name="SyntheticInput", daemon=True)
+        self._thread.start()
+
+    def run(self, api):
+        """Feed every event on the calling thread; returns when all are dispatched"""
+        ring = api.input_ring
+        speed = self.speed
+        saved_clock = api.event_clock
+        api.event_clock = speed <= 0
+        start_ns = time.perf_counter_ns()
+        try:
+            for index, (t_ns, kind, key) in enumerate(self.events):
+                if self._stopped.is_set():
+                    break
+                if speed > 0:
+                    remaining = (start_ns + t_ns / speed - time.perf_counter_ns()) / 1e9
+                    if remaining > 0:
+                        time.sleep(remaining)
+                    api.feed_input(kind, key, time.perf_counter_ns())
+                else:
+                    if index % (ring.capacity // 2) == 0:
+                        ring.wait_idle(5)  # Back to back, but never outrun the ring
+                    api.feed_input(kind, key, start_ns + t_ns)
+                self.fed += 1
+            ring.wait_idle(30)
+        finally:
+            api.event_clock = saved_clock
+
+    def join(self, timeout=None):
+        """Wait for a started source to finish feeding"""
+        if self._thread:
+            self._thread.join(timeout)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def replay_input_trace(api, path, speed=1.0):
+    """Feed a recorded trace through api's dispatcher at the given speed"""
+    source = SyntheticInputSource(read_input_trace(path), speed)
+    ring = api.input_ring
+    dropped_before = ring.dropped
+    prefiltered_before = api.prefiltered
+    saved_timing = (api.combo_timeout, api.long_press_threshold)
+    if speed > 0:
+        api.combo_timeout /= speed
+        api.long_press_threshold /= speed
+    
+    start_ns = time.perf_counter_ns()
+    try:
+        source.run(api)
+    finally:
+        api.combo_timeout, api.long_press_threshold = saved_timing
+    
+    return {
+        'events': len(source.events),
+        'elapsed_s': (time.perf_counter_ns() - start_ns) / 1e9,
+        'dropped': ring.dropped - dropped_before,
+        'prefiltered': api.prefiltered - prefiltered_before,
+    }
+
+
+class LatencyHistograms:
+    """Fixed-bucket perf_counter_ns histograms for each hot-path stage"""
+    # hook: OS hook -> dispatcher, trigger includes enqueue, write: enqueued ->
+    # drained to the socket, ack: written -> Discord's response for the nonce
+    STAGES = ('hook', 'normalize', 'combo', 'trigger', 'enqueue', 'write', 'ack')
+    # Bucket upper bounds: 250ns doubling up to ~4s; one overflow bucket after
+    BOUNDS_NS = tuple(250 << i for i in range(25))
+    MAX_MARKS = 1024  # Outstanding write -> ack timestamps kept
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self._counts = {stage: [0] * (len(self.BOUNDS_NS) + 1) for stage in self.STAGES}
+        self._max = dict.fromkeys(self.STAGES, 0)
+        self._marks = {}
+
+    def record(self, stage, elapsed_ns):
+        self._counts[stage][bisect.bisect_left(self.BOUNDS_NS, elapsed_ns)] += 1
+        if elapsed_ns > self._max[stage]:
+            self._max[stage] = elapsed_ns
+
+    def mark(self, key, t_ns):
+        """Remember when key (a nonce) was written, for record_since()"""
+        if len(self._marks) >= self.MAX_MARKS:
+            self._marks.clear()  # Unanswered nonces; don't grow forever
+        self._marks[key] = t_ns
+
+    def record_since(self, key, stage):
+        start = self._marks.pop(key, None)
+        if start is not None:
+            self.record(stage, time.perf_counter_ns() - start)
+
+    def snapshot(self):
+        """Per-stage count, approximate p50/p99 (bucket upper bound), max and buckets in us"""
+        result = {}
+        for stage in self.STAGES:
+            counts = list(self._counts[stage])
+            total = sum(counts)
+            stats = {
+                'count': total,
+                'p50_us': min(self._quantile_us(counts, total, 0.50), self._max[stage] / 1000),
+                'p99_us': min(self._quantile_us(counts, total, 0.99), self._max[stage] / 1000),
+                'max_us': self._max[stage] / 1000,
+                'buckets': [[bound / 1000, n] for bound, n in zip(self.BOUNDS_NS + (None,), counts) if n],
+            }
+            result[stage] = stats
+        return result
+
+    def _quantile_us(self, counts, total, q):
+        if not total:
+            return 0.0
+        threshold = q * total
+        seen = 0
+        for index, n in enumerate(counts):
+            seen += n
+            if seen >= threshold:
+                if index < len(self.BOUNDS_NS):
+                    return self.BOUNDS_NS[index] / 1000
+                break
+        return self.BOUNDS_NS[-1] / 1000
+
+    def dump(self, path):
+        data = {'enabled': self.enabled, 'unix_time': time.time(), 'stages': self.snapshot()}
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+        return path
+
+
+class UiUpdateChannel:
+    """Coalesced, frame-rate-limited updates to the web UI"""
+    FRAME_INTERVAL = 1 / 60
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.window = None
+        self.visible = True
+        self._pending = {}  # key -> JS statement, insertion ordered
+        self._lock = threading.Lock()
+        self._flush_handle = None
+        self._last_flush = 0.0
+        self.flushes = 0
+        self.coalesced = 0
+
+    def attach(self, window):
+        with self._lock:
+            self.window = window
+            self._schedule_locked()
+
+    def set_visible(self, visible):
+        with self._lock:
+            self.visible = visible
+            self._schedule_locked()
+
+    def post(self, key, script):
+        """Queue a JS statement, replacing any pending one with the same key"""
+        with self._lock:
+            if key in self._pending:
+                self.coalesced += 1
+            self._pending[key] = script
+            self._schedule_locked()
+
+    def _schedule_locked(self):
+        if self._flush_handle is not None or not self._pending:
+            return
+        if self.window is None or not self.visible:
+            return
+        delay = max(0.0, self._last_flush + self.FRAME_INTERVAL - time.monotonic())
+        self._flush_handle = self.scheduler.call_later(delay, self._flush)
+
+    def _flush(self):
+        with self._lock:
+            self._flush_handle = None
+            if not self._pending or self.window is None or not self.visible:
+                return
+            scripts = list(self._pending.values())
+            self._pending.clear()
+            self._last_flush = time.monotonic()
+            window = self.window
+
+        # One bridge round-trip per frame; isolate statements so one failure
+        # doesn't drop the rest of the batch
+        batch = ''.join(f"try{{{js}}}catch(e){{console.error(e)}}" for js in scripts)
+        try:
+            window.evaluate_js(batch)
+            self.flushes += 1
+        except Exception as e:
+            print(f"[ERROR] UI update failed: {e}")
+
+
+class VoiceFrameBuilder:
+    """Builds Discord IPC frames into a reusable buffer"""
+    HEADER = struct.Struct('<II')
+    OP_FRAME = 1
+    _NONCE_MARK = 'NONCE_PLACEHOLDER'
+
+    def __init__(self):
+        self._nonces = itertools.count(1)
+        self._templates = {}  # (field, value) -> (body prefix, body suffix)
+        for field in ('mute', 'deaf'):
+            for value in (True, False):
+                body = json.dumps({
+                    'cmd': 'SET_VOICE_SETTINGS',
+                    'args': {field: value},
+                    'nonce': self._NONCE_MARK
+                }).encode('utf-8')
+                prefix, suffix = body.split(self._NONCE_MARK.encode('ascii'))
+                self._templates[(field, value)] = (prefix, suffix)
+
+    def next_nonce(self):
+        # next() on itertools.count is atomic under the GIL
+        return str(next(self._nonces))
+
+    def build_voice_into(self, buf, field, value, nonce):
+        """Write a SET_VOICE_SETTINGS frame into buf; returns the frame length"""
+        template = self._templates.get((field, bool(value)))
+        if template is None:
+            return self.build_json_into(buf, self.OP_FRAME, {
+                'cmd': 'SET_VOICE_SETTINGS', 'args': {field: value}, 'nonce': nonce
+            })
+        prefix, suffix = template
+        nonce_bytes = nonce.encode('ascii')
+        body_len = len(prefix) + len(nonce_bytes) + len(suffix)
+        total = self.HEADER.size + body_len
+        if len(buf) < total:
+            buf.extend(bytes(total - len(buf)))
+
+        self.HEADER.pack_into(buf, 0, self.OP_FRAME, body_len)
+        pos = self.HEADER.size
+        buf[pos:pos + len(prefix)] = prefix
+        pos += len(prefix)
+        buf[pos:pos + len(nonce_bytes)] = nonce_bytes
+        pos += len(nonce_bytes)
+        buf[pos:pos + len(suffix)] = suffix
+        return total
+
+    def build_json_into(self, buf, op, payload):
+        """Generic path for any other payload"""
+        encoded = json.dumps(payload).encode('utf-8')
+        total = self.HEADER.size + len(encoded)
+        if len(buf) < total:
+            buf.extend(bytes(total - len(buf)))
+        self.HEADER.pack_into(buf, 0, op, len(encoded))
+        buf[self.HEADER.size:total] = encoded
+        return total
+
+
+class VoiceState:
+    """Optimistic mute/deaf state reconciled against Discord by nonce"""
+    FIELDS = ('mute', 'deaf')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.confirmed = {'mute': False, 'deaf': False}
+        self._pending = collections.OrderedDict()  # nonce -> {field: value}
+
+    def view(self):
+        with self._lock:
+            return self._view_locked()
+
+    def _view_locked(self):
+        state = dict(self.confirmed)
+        for changes in self._pending.values():
+            state.update(changes)
+        return state
+
+    def apply(self, changes, nonce):
+        """Set {field: True/False, or None to flip} in the optimistic view,
+        tracked under nonce; returns the resolved {field: value}"""
+        with self._lock:
+            view = self._view_locked()
+            resolved = {field: (not view.get(field, False)) if value is None else bool(value)
+                        for field, value in changes.items()}
+            self._pending[nonce] = resolved
+        return resolved
+
+    def toggle(self, field, nonce):
+        """Flip field in the optimistic view and track it under nonce"""
+        return self.apply({field: None}, nonce)[field]
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def acknowledge(self, nonce, data=None):
+        """Discord answered nonce; data is the full voice settings it returned"""
+        with self._lock:
+            self._pending.pop(nonce, None)
+            if data:
+                self._confirm_locked(data)
+
+    def discard(self, nonce):
+        """Command was never sent, failed or timed out - drop it from the view"""
+        with self._lock:
+            return self._pending.pop(nonce, None) is not None
+
+    def confirm(self, data):
+        """Authoritative state from a VOICE_SETTINGS_UPDATE dispatch"""
+        with self._lock:
+            self._confirm_locked(data)
+
+    def _confirm_locked(self, data):
+        for field in self.FIELDS:
+            if field in data:
+                self.confirmed[field] = bool(data[field])
+
+    def reset(self):
+        """Connection dropped - nothing in flight will be answered"""
+        with self._lock:
+            self._pending.clear()
+
+
+# === Discord IPC ===
+
+IPC_OP_HANDSHAKE = 0
+IPC_OP_FRAME = 1
+IPC_OP_CLOSE = 2
+IPC_OP_PING = 3
+IPC_OP_PONG = 4
+
+
+class DiscordIPCError(Exception):
+    """Error reported by Discord over IPC (evt ERROR or a CLOSE frame)"""
+
+    def __init__(self, code, message):
+        super().__init__(f"[{code}] {message}")
+        self.code = code
+        self.message = message
+
+
+def find_ipc_path():
+    """Locate the Discord client's IPC endpoint (named pipe or Unix socket)"""
+    if sys.platform == 'win32':
+        try:
+            pipes = set(os.listdir(r"\\?\pipe"))
+        except OSError:
+            return None
+        for i in range(10):
+            if f"discord-ipc-{i}" in pipes:
+                return rf"\\?\pipe\discord-ipc-{i}"
+        return None
+
+    base_dirs = []
+    for var in ('XDG_RUNTIME_DIR', 'TMPDIR', 'TMP', 'TEMP'):
+        value = os.environ.get(var)
+        if value:
+            base_dirs.append(value)
+    base_dirs.append('/tmp')
+    for base in base_dirs:
+        # Plain install, then the snap / flatpak sandboxes
+        for sub in ('', 'snap.discord', 'app/com.discordapp.Discord', 'app/com.discordapp.DiscordCanary'):
+            for i in range(10):
+                path = os.path.join(base, sub, f"discord-ipc-{i}")
+                if os.path.exists(path):
+                    return path
+    return None
+
+
+class DiscordIPCProtocol(asyncio.Protocol):
+    """asyncio Protocol for the Discord IPC framing ('<II' op/length + JSON)"""
+    HEADER = struct.Struct('<II')
+
+    def __init__(self, on_frame, wanted_events=()):
+        self.on_frame = on_frame  # on_frame(op, payload_dict)
+        self.transport = None
+        self._buf = bytearray()
+        self._paused = False
+        self._drain_waiters = []
+        self._dispatch_marks = (b'"cmd":"DISPATCH"', b'"cmd": "DISPATCH"')
+        self._event_marks = ()
+        self.closed = None
+        self.close_reason = None
+        self.frames = 0
+        self.skipped = 0
+        self.set_wanted_events(wanted_events)
+
+    def set_wanted_events(self, events):
+        marks = []
+        for evt in events:
+            marks.append(f'"evt":"{evt}"'.encode('ascii'))
+            marks.append(f'"evt": "{evt}"'.encode('ascii'))
+        self._event_marks = tuple(marks)
+
+    # --- asyncio.Protocol ---
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def data_received(self, data):
+        buf = self._buf
+        buf += data
+        size = len(buf)
+        pos = 0
+        header = self.HEADER
+        view = memoryview(buf)
+        try:
+            while size - pos >= header.size:
+                op, length = header.unpack_from(view, pos)
+                start = pos + header.size
+                end = start + length
+                if end > size:
+                    break  # partial frame, wait for more data
+                pos = end
+                self.frames += 1
+                if op == IPC_OP_FRAME and self._is_unwanted_dispatch(buf, start, end):
+                    self.skipped += 1
+                    continue
+                self._handle_frame(op, view[start:end])
+        finally:
+            view.release()
+        if pos:
+            del buf[:pos]
+
+    def _is_unwanted_dispatch(self, buf, start, end):
+        for mark in self._dispatch_marks:
+            if buf.find(mark, start, end) != -1:
+                break
+        else:
+            return False  # a command response, always wanted
+        for mark in self._event_marks:
+            if buf.find(mark, start, end) != -1:
+                return False
+        return True
+
+    def _handle_frame(self, op, body):
+        try:
+            payload = json.loads(bytes(body))
+        except ValueError as e:
+            print(f"[ERROR] Bad IPC frame: {e}")
+            return
+        finally:
+            body.release()
+
+        if op == IPC_OP_PING:
+            self.transport.write(self._encode(IPC_OP_PONG, payload))
+        elif op == IPC_OP_CLOSE:
+            self.close_reason = DiscordIPCError(payload.get('code'), payload.get('message'))
+            self.transport.close()
+        elif op == IPC_OP_FRAME:
+            self.on_frame(op, payload)
+
+    def connection_lost(self, exc):
+        error = self.close_reason or exc or ConnectionError("Discord IPC connection closed")
+        if not self.closed.done():
+            self.closed.set_result(error)
+        self._wake_drainers(error)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake_drainers(None)
+
+    # --- writer interface (used by RpcSender) ---
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        if self.transport.is_closing():
+            raise ConnectionError("Discord IPC connection closed")
+        if not self._paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+    def _wake_drainers(self, error):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if error is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(error if isinstance(error, BaseException) else ConnectionError(error))
+
+    def _encode(self, op, payload):
+        encoded = json.dumps(payload).encode('utf-8')
+        return self.HEADER.pack(op, len(encoded)) + encoded
+
+
+class DiscordIPC:
+    """Discord RPC client over DiscordIPCProtocol"""
+    WANTED_EVENTS = ('READY', 'ERROR', 'VOICE_SETTINGS_UPDATE')
+
+    def __init__(self, client_id, on_message, next_nonce, loop=None):
+        self.client_id = str(client_id)
+        self.on_message = on_message
+        self.next_nonce = next_nonce
+        self.loop = loop
+        self.protocol = None
+        self._waiters = {}  # nonce -> Future
+        self._ready = None
+
+    async def connect(self, path=None, timeout=5):
+        """Open the IPC endpoint and complete the handshake (READY)"""
+        self.loop = asyncio.get_running_loop()
+        path = path or find_ipc_path()
+        if not path:
+            raise ConnectionError("找不到 Discord IPC，請確認 Discord 已啟動")
+
+        self._ready = self.loop.create_future()
+        factory = lambda: DiscordIPCProtocol(self._on_frame, self.WANTED_EVENTS)
+        if sys.platform == 'win32':
+            connect = self.loop.create_pipe_connection(factory, path)
+        else:
+            connect = self.loop.create_unix_connection(factory, path)
+        _, self.protocol = await asyncio.wait_for(connect, timeout)
+
+        self.write(self.protocol._encode(IPC_OP_HANDSHAKE, {'v': 1, 'client_id': self.client_id}))
+        waiter = asyncio.ensure_future(self._ready)
+        closed = self.protocol.closed
+        done, _ = await asyncio.wait({waiter, closed}, timeout=timeout,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if waiter not in done:
+            waiter.cancel()
+            self.close()
+            raise closed.result() if closed.done() else ConnectionError("Discord handshake timed out")
+        return self._ready.result()
+
+    # --- writer interface for RpcSender ---
+
+    def write(self, data):
+        self.protocol.write(data)
+
+    async def drain(self):
+        await self.protocol.drain()
+
+    # --- commands ---
+
+    async def command(self, cmd, args=None, evt=None, timeout=10):
+        nonce = self.next_nonce()
+        payload = {'cmd': cmd, 'args': args or {}, 'nonce': nonce}
+        if evt:
+            payload['evt'] = evt
+        future = self.loop.create_future()
+        self._waiters[nonce] = future
+        try:
+            self.write(self.protocol._encode(IPC_OP_FRAME, payload))
+            await self.protocol.drain()
+            # Fail fast if the pipe closes mid-command instead of waiting out the timeout
+            closed = self.protocol.closed
+            done, _ = await asyncio.wait({future, closed}, timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if future in done:
+                return future.result()
+            future.cancel()
+            raise closed.result() if closed.done() else asyncio.TimeoutError()
+        finally:
+            self._waiters.pop(nonce, None)
+
+    async def authorize(self, client_id, scopes):
+        # Waits for the user to click Authorize in Discord
+        return await self.command('AUTHORIZE', {'client_id': str(client_id), 'scopes': scopes}, timeout=120)
+
+    async def authenticate(self, access_token):
+        return await self.command('AUTHENTICATE', {'access_token': access_token})
+
+    async def subscribe(self, evt, args=None):
+        return await self.command('SUBSCRIBE', args, evt=evt)
+
+    def close(self):
+        if self.protocol and self.protocol.transport:
+            self.protocol.transport.close()
+
+    async def wait_closed(self):
+        """Wait until the connection drops; returns the reason"""
+        return await self.protocol.closed
+
+    def stats(self):
+        protocol = self.protocol
+        return {'frames': protocol.frames, 'skipped': protocol.skipped} if protocol else {}
+
+    def _on_frame(self, op, payload):
+        evt = payload.get('evt')
+        if evt == 'READY' and self._ready and not self._ready.done():
+            self._ready.set_result(payload)
+            return
+
+        waiter = self._waiters.get(payload.get('nonce'))
+        if waiter is not None and not waiter.done():
+            if evt == 'ERROR':
+                data = payload.get('data') or {}
+                waiter.set_exception(DiscordIPCError(data.get('code'), data.get('message')))
+            else:
+                waiter.set_result(payload)
+            return
+
+        try:
+            self.on_message(payload)
+        except Exception as e:
+            print(f"[ERROR] RPC message handler failed: {e}")
+
+
+class Backoff:
+    """Capped exponential backoff with full jitter"""
+
+    def __init__(self, base=0.25, cap=15.0):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next_delay(self):
+        ceiling = self.base * (2 ** self.attempt)
+        if ceiling < self.cap:
+            self.attempt += 1
+        else:
+            # Stop growing at the cap: 2 ** attempt overflows float after ~1024 tries
+            ceiling = self.cap
+        return random.uniform(0, ceiling)
+
+    def reset(self):
+        self.attempt = 0
+
+
+class OAuthError(Exception):
+    """Non-200 answer from the OAuth2 token endpoint"""
+
+    def __init__(self, status, text):
+        super().__init__(f"HTTP {status}: {text}")
+        self.status = status
+        self.text = text
+
+
+class OAuthTokenClient:
+    """Discord OAuth2 token exchange / refresh off the event loop"""
+
+    def __init__(self, token_url=OAUTH_TOKEN_URL, timeout=10):
+        self.token_url = token_url
+        self.timeout = timeout
+        self._session = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="OAuth")
+
+    async def exchange_code(self, client_id, client_secret, code):
+        return await self._request({
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': OAUTH_REDIRECT_URI
+        })
+
+    async def refresh(self, client_id, client_secret, refresh_token):
+        return await self._request({
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token
+        })
+
+    async def _request(self, data):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._post, data)
+
+    def _post(self, data):
+        # Runs on the OAuth worker thread
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+        resp = self._session.post(
+            self.token_url,
+            data=data,
+            headers={'Content-Type': 'application/x-www-form-urlencoded'},
+            timeout=self.timeout
+        )
+        if resp.status_code != 200:
+            raise OAuthError(resp.status_code, resp.text)
+        return resp.json()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        if self._session is not None:
+            self._session.close()
+
+
+class RpcQueueFull(Exception):
+    """Raised (via the returned future) when the RPC send queue is full"""
+
+
+class RpcSender:
+    """Single writer task that owns the Discord IPC socket"""
+
+    def __init__(self, loop, writer, frames, max_depth=32, perf=None):
+        self.loop = loop
+        self.writer = writer
+        self.frames = frames  # VoiceFrameBuilder
+        self.perf = perf  # LatencyHistograms, or None
+        self.max_depth = max_depth
+        self._buf = bytearray(256)  # reused for every frame, only touched by the writer task
+        self._queue = collections.deque()  # [op, payload, merge_key, future, enqueued_ns, barrier]
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._task = None
+        self._closed = False
+        self.sent = 0
+        self.merged = 0
+        self.rejected = 0
+
+    def start(self):
+        """Start the writer task - must be called on the RPC event loop"""
+        self._wakeup = asyncio.Event()
+        self._task = self.loop.create_task(self._run())
+        if self._queue:
+            self._wakeup.set()
+
+    def depth(self):
+        return len(self._queue)
+
+    def submit(self, op, payload, merge_key=None, barrier=()):
+        """Enqueue a frame from any thread; returns a concurrent.futures.Future"""
+        # The future resolves True once written, False if a later frame with
+        # the same merge_key replaced it, RpcQueueFull if the queue is full.
+        # barrier: other merge keys this frame covers, never merged past
+        perf = self.perf
+        start_ns = time.perf_counter_ns() if perf is not None and perf.enabled else 0
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                future.set_exception(ConnectionError("RPC sender is closed"))
+                return future
+
+            if merge_key is not None:
+                for item in reversed(self._queue):
+                    if item[2] == merge_key:
+                        # Latest value wins; the older frame is never written
+                        item[1] = payload
+                        superseded, item[3] = item[3], future
+                        self.merged += 1
+                        superseded.set_result(False)
+                        return future
+                    if merge_key in item[5]:
+                        break  # Merging further back would reorder around this frame
+
+            if len(self._queue) >= self.max_depth:
+                self.rejected += 1
+                future.set_exception(RpcQueueFull(f"RPC send queue full ({self.max_depth})"))
+                return future
+
+            was_empty = not self._queue
+            self._queue.append([op, payload, merge_key, future, start_ns, barrier])
+
+        if was_empty and self._wakeup is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError as e:  # loop already closed
+                self._fail_pending(ConnectionError(str(e)))
+        if start_ns:
+            perf.record('enqueue', time.perf_counter_ns() - start_ns)
+        return future
+
+    def close(self, reason="RPC connection closed"):
+        with self._lock:
+            self._closed = True
+        if self._task:
+            self._task.cancel()
+        self._fail_pending(ConnectionError(reason))
+
+    def _fail_pending(self, error):
+        with self._lock:
+            pending = list(self._queue)
+            self._queue.clear()
+        for item in pending:
+            if not item[3].done():
+                item[3].set_exception(error)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                with self._lock:
+                    if not self._queue:
+                        break
+                    op, payload, _, future, enqueued_ns, _ = self._queue.popleft()
+                try:
+                    if type(payload) is tuple:
+                        length = self.frames.build_voice_into(self._buf, *payload)
+                    else:
+                        length = self.frames.build_json_into(self._buf, op, payload)
+                    # Transports may hold on to what they are given, so hand
+                    # over an immutable snapshot rather than the shared buffer
+                    self.writer.write(bytes(memoryview(self._buf)[:length]))
+                    await self.writer.drain()
+                except Exception as e:
+                    # Socket is gone - fail this frame and everything behind it
+                    future.set_exception(e)
+                    with self._lock:
+                        self._closed = True
+                    self._fail_pending(ConnectionError(f"RPC write failed: {e}"))
+                    return
+                self.sent += 1
+                if enqueued_ns and self.perf is not None:
+                    now = time.perf_counter_ns()
+                    self.perf.record('write', now - enqueued_ns)
+                    if type(payload) is tuple:
+                        self.perf.mark(payload[2], now)  # nonce -> written at
+                future.set_result(True)
+
+
+# Hold actions: value of 'mute' while the binding is held (inverted on release)
+HOLD_ACTIONS = {
+    'ptt': False,  # Push-to-talk: unmuted while held
+    'ptm': True,  # Push-to-mute: muted while held
+}
+
+# Built-in actions as single-step macros (see AppConfig.parse_macro_step)
+ACTION_MACROS = {
+    'mute': (('voice', 'mute', None),),
+    'deafen': (('voice', 'deaf', None),),
+    'media': (('media',),),
+}
+
+
+class SequenceNode:
+    """One state of the sequence matcher"""
+    __slots__ = ('children', 'next', 'actions')
+
+    def __init__(self):
+        self.children = {}  # chord -> node, the trie edges
+        self.next = {}  # chord -> node, every transition once compiled
+        self.actions = []  # Filled on nodes that complete a sequence
+
+
+class SequenceTrie:
+    """Multi-stroke bindings ('Mouse5, M') compiled into a DFA over chords"""
+    __slots__ = ('root', 'node', 'deadline')
+
+    def __init__(self):
+        self.root = SequenceNode()
+        self.node = self.root
+        self.deadline = 0.0  # Next stroke must start before this (seconds)
+
+    def __bool__(self):
+        return bool(self.root.children)
+
+    def add(self, strokes, action):
+        node = self.root
+        for stroke in strokes:
+            node = node.children.setdefault(stroke, SequenceNode())
+        if action not in node.actions:
+            node.actions.append(action)
+
+    def compile(self):
+        """Fill in every node's transitions, breadth first"""
+        root = self.root
+        root.next = dict(root.children)
+        queue = collections.deque()
+        for child in root.children.values():
+            queue.append((child, root))
+        while queue:
+            node, fallback = queue.popleft()
+            # A sequence ending here also ends every bound suffix of it
+            for action in fallback.actions:
+                if action not in node.actions:
+                    node.actions.append(action)
+            node.next = dict(fallback.next)
+            node.next.update(node.children)
+            for stroke, child in node.children.items():
+                queue.append((child, fallback.next.get(stroke, root)))
+        self.node = root
+
+    def advance(self, stroke, started, ended, timeout):
+        """Feed one completed chord (pressed at `started`, released at `ended`).
+        Returns the actions of the sequence it completes, else ()."""
+        node = self.node
+        if node is not self.root and started > self.deadline:
+            node = self.root  # Too slow: the pending sequence timed out
+        node = node.next.get(stroke, self.root)
+        if node.actions:
+            # Shortest match wins: 'A, B' fires before 'A, B, C' could
+            self.node = self.root
+            return node.actions
+        self.node = node
+        self.deadline = ended + timeout
+        return ()
+
+    def reset(self):
+        self.node = self.root
+
+
+class ActionExecutor:
+    """Runs action macros in trigger order on one asyncio loop thread"""
+
+    def __init__(self, api, write_timeout=1.0):
+        self.api = api
+        self.write_timeout = write_timeout  # Seconds to wait for a voice frame to be written
+        self.loop = None
+        self._queue = None
+        self._lock = threading.Lock()
+        self._backlog = 0  # Submitted macros not finished yet
+        self.last_run = None  # {'name', 'steps': [(step, offset_ms), ...]}
+
+    @property
+    def idle(self):
+        return self._backlog == 0
+
+    def submit(self, name, steps):
+        """Queue a macro from any thread"""
+        with self._lock:
+            if self.loop is None:
+                self._start_locked()
+            self._backlog += 1
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, (name, steps))
+
+    def _start_locked(self):
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self._queue = asyncio.Queue()
+            self.loop.create_task(self._worker())
+            ready.set()
+            self.loop.run_forever()
+        
+        threading.Thread(target=run, name="ActionExecutor", daemon=True).start()
+        ready.wait()
+
+    async def _worker(self):
+        while True:
+            name, steps = await self._queue.get()
+            try:
+                await self._run(name, steps)
+            except Exception as e:
+                print(f"[ERROR] Action {name} failed: {e}")
+            finally:
+                with self._lock:
+                    self._backlog -= 1
+
+    async def _run(self, name, steps):
+        loop = self.loop
+        start = loop.time()
+        offset = 0.0  # Where the schedule is, in seconds from start
+        timings = []
+        group = {}  # Consecutive voice steps waiting to go out as one frame
+
+        async def flush():
+            nonlocal offset
+            if not group:
+                return
+            changes = dict(group)
+            group.clear()
+            future = self.api.set_voice_settings(changes)
+            timings.append((changes, (loop.time() - start) * 1000))
+            try:
+                # Keep ordering: the frame is on the wire before the next step
+                await asyncio.wait_for(asyncio.wrap_future(future), self.write_timeout)
+            except Exception as e:
+                print(f"[ERROR] Action {name} failed: {e!r}")
+            offset = loop.time() - start
+
+        for step in steps:
+            kind = step[0]
+            if kind == 'voice':
+                if step[1] in group:
+                    await flush()  # Same field twice: send in order, don't collapse
+                group[step[1]] = step[2]
+                continue
+            
+            await flush()
+            if kind == 'wait':
+                offset += step[1]
+                delay = start + offset - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif kind == 'media':
+                await self.api.press_media_key()
+            elapsed = loop.time() - start
+            if kind != 'wait':
+                offset = elapsed  # Real work moves the schedule; sleep overshoot doesn't
+            timings.append((step, elapsed * 1000))
+        await flush()
+
+        self.last_run = {'name': name, 'steps': timings}
+        print(f"[DEBUG] Action {name} done in {(loop.time() - start) * 1000:.1f} ms")
+
+
+class TraySprites:
+    """Tray icon images for each app state, rendered once and cached on disk"""
+    STATES = ('normal', 'muted', 'deafened', 'disconnected')
+    BACKGROUNDS = {
+        'normal': (88, 101, 242),  # Discord blurple
+        'muted': (88, 101, 242),
+        'deafened': (237, 66, 69),  # Discord red
+        'disconnected': (116, 127, 141),  # Discord grey
+    }
+
+    def __init__(self, size=64, cache_dir=None):
+        self.size = size
+        self.cache_dir = cache_dir or TRAY_CACHE_DIR
+        self._images = {}
+        self._handles = {}  # state -> native HICON (Windows), never destroyed
+        self._lock = threading.Lock()
+
+    def get(self, state):
+        with self._lock:
+            if not self._images:
+                self._load()
+            return self._images[state]
+
+    def handle(self, state):
+        """Native icon handle for a state (Windows), loaded once from a cached .ico"""
+        handle = self._handles.get(state)
+        if handle is None:
+            image = self.get(state)
+            with self._lock:
+                handle = self._handles.get(state)
+                if handle is None:
+                    handle = self._handles[state] = self._load_handle(state, image)
+        return handle
+
+    def owns(self, handle):
+        return handle is not None and handle in self._handles.values()
+
+    def make_icon(self, name, state, title, menu):
+        """pystray Icon for a state; on Windows, show_state() swaps between
+        cached native handles instead of re-encoding the image every time"""
+        import pystray
+        sprites = self
+
+        class Icon(pystray.Icon):
+            def show_state(self, state):
+                self.sprite_state = state
+                self.icon = sprites.get(state)
+
+            # win32 backend hooks (unused elsewhere)
+            def _assert_icon_handle(self):
+                if not self._icon_handle:
+                    self._icon_handle = sprites.handle(self.sprite_state)
+                if not self._icon_handle:
+                    super()._assert_icon_handle()
+
+            def _release_icon(self):
+                if sprites.owns(self._icon_handle):
+                    self._icon_handle = None
+                else:
+                    super()._release_icon()
+
+        icon = Icon(name, self.get(state), title, menu)
+        icon.sprite_state = state
+        return icon
+
+    def _path(self, state, ext='png'):
+        return os.path.join(self.cache_dir, f"tray_{state}_{self.size}_v{TRAY_SPRITE_VERSION}.{ext}")
+
+    def _load_handle(self, state, image):
+        path = self._path(state, 'ico')
+        try:
+            if not os.path.exists(path):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                image.save(path + '.tmp', format='ICO')
+                os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"[WARN] Could not cache tray icon: {e}")
+            return 0  # pystray falls back to its own temp file
+        user32 = ctypes.WinDLL('user32')
+        user32.LoadImageW.restype = ctypes.c_void_p
+        user32.LoadImageW.argtypes = (ctypes.c_void_p, ctypes.c_wchar_p, ctypes.c_uint,
+                                      ctypes.c_int, ctypes.c_int, ctypes.c_uint)
+        # IMAGE_ICON, LR_LOADFROMFILE | LR_DEFAULTSIZE
+        return user32.LoadImageW(None, path, 1, 0, 0, 0x10 | 0x40) or 0
+
+    def _load(self):
+        from PIL import Image
+        
+        for state in self.STATES:
+            path = self._path(state)
+            try:
+                with Image.open(path) as cached:
+                    self._images[state] = cached.convert('RGB')
+                continue
+            except (OSError, ValueError):
+                pass
+            image = self.render(state)
+            self._images[state] = image
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                image.save(path + '.tmp', format='PNG')
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                print(f"[WARN] Could not cache tray icon: {e}")
+
+    def render(self, state):
+        """Draw the Discord-style microphone icon for one state"""
+        from PIL import Image, ImageDraw
+        
+        width, height = 64, 64
+        background = self.BACKGROUNDS[state]
+        highlight = tuple(min(255, c + 11) for c in background)
+        
+        # Create image with transparency support
+        image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        dc = ImageDraw.Draw(image)
+        
+        # Main background circle with a subtle inner highlight ring
+        dc.ellipse([2, 2, 62, 62], fill=background + (255,))
+        dc.ellipse([4, 4, 60, 60], fill=highlight + (255,))
+        dc.ellipse([6, 6, 58, 58], fill=background + (255,))
+        
+        # Draw microphone icon (stylized, centered)
+        mic_color = (255, 255, 255, 255)
+        
+        # Microphone body (pill shape)
+        dc.rounded_rectangle([26, 14, 38, 34], radius=6, fill=mic_color)
+        
+        # Microphone stand arc (U shape around the mic)
+        dc.arc([20, 22, 44, 44], 0, 180, fill=mic_color, width=3)
+        
+        # Microphone stand vertical line
+        dc.rectangle([30, 42, 34, 48], fill=mic_color)
+        
+        # Microphone base (horizontal line)
+        dc.rounded_rectangle([22, 47, 42, 51], radius=2, fill=mic_color)
+        
+        # Muted / deafened: red strike-through with a background-coloured gap
+        if state in ('muted', 'deafened'):
+            dc.line([16, 12, 48, 52], fill=background + (255,), width=9)
+            dc.line([16, 12, 48, 52], fill=(237, 66, 69, 255) if state == 'muted' else mic_color, width=5)
+        
+        # Convert to RGB for pystray compatibility (with background-colour corners)
+        rgb_image = Image.new('RGB', (width, height), background)
+        rgb_image.paste(image, mask=image.split()[3])
+        
+        if self.size != width:
+            rgb_image = rgb_image.resize((self.size, self.size), Image.LANCZOS)
+        return rgb_image
+
 
 class DiscordAPI:
     """Bridge between Web UI and Discord RPC"""
     
-    def __init__(self):
+    def __init__(self, start_listeners=True, input_source=None):
         self.window = None
+        self.headless = False  # --headless: the window is an optional client
+        self.ui_requested = threading.Event()  # Headless: tray asked for the window
         self.rpc_client = None
+        self.rpc_sender = None  # RpcSender, only while connected
+        self.rpc_generation = 0  # Bumped on every connect() so stale supervisors exit
+        self.endpoint_poll_interval = 0.25  # Seconds between checks for Discord's IPC endpoint
+        self.rpc_metrics = {
+            'connects': 0,
+            'reconnects': 0,
+            'failed_attempts': 0,
+            'last_reconnect_s': None,  # Connection lost -> subscribed again
+            'max_reconnect_s': None,
+        }
+        self.frames = VoiceFrameBuilder()  # outlives connections so nonces never repeat
         self.loop = None
         self.running = False
-        self.current_voice_settings = {'deaf': False, 'mute': False}
+        self.voice_state = VoiceState()
+        self.pending_timeout = 3.0  # Seconds before an unanswered toggle is dropped
         self.binding_target = None
         self.binding_pending = False  # Block action triggers during binding
         self.tray_icon = None
-        
-        # Combo key tracking - support any two keys
-        self.pressed_keys = []  # Track all currently pressed keys (Ordered List)
+        self.tray_sprites = TraySprites()
+        self.tray_state = None  # Sprite currently shown ('normal', 'muted', ...)
+        self.tray_lock = threading.Lock()  # Voice / connection / tray threads all update the icon
+        self.tray_update_pending = False  # A sprite swap is queued on the UI thread
+        self.rpc_connected = False
+        
+        # Combo key tracking: held keys and buttons, in press order
+        self.held = HeldKeys(self._os_vks)
+        self.key_resync_interval = 2.0  # Seconds between OS key-state checks (Windows)
         self.last_key_time = 0  # Time of last key press for combo detection
+        self.stroke_open = False  # A key went down since the last completed chord
         self.combo_timeout = 0.5  # Seconds to consider keys as part of a combo
         
         # Long press tracking for combo binding
         self.first_key_press_time = None  # Time when first key was pressed
         self.long_press_threshold = 0.8  # Seconds to trigger long press binding mode
-        self.long_press_timer = None  # Timer thread for long press detection
+        self.long_press_timer = None  # TimerHandle for long press detection
         self.pending_combo = None  # The combo being built during long press
         self.long_press_active = False  # Flag to indicate long press mode is active
-        
-        # Config
-        self.config = self.load_config()
-        self.saved_access_token = self.config.get('access_token')
-        self.saved_refresh_token = self.config.get('refresh_token')
-        
-        # Start input listeners
-        self.mouse_listener = mouse.Listener(on_click=self.on_click)
-        self.mouse_listener.start()
-        
-        self.keyboard_listener = keyboard.Listener(
-            on_press=self.on_key_press,
-            on_release=self.on_key_release
-        )
-        self.keyboard_listener.start()
+        self.event_clock = False  # True: timing comes only from event timestamps (back-to-back replay)
+        
+        # All hold/tap timing runs on one scheduler thread
+        self.scheduler = TimerScheduler()
+        
+        # Batched, per-frame updates to the web UI, on their own thread so a
+        # slow evaluate_js never delays the timers above
+        self.ui_scheduler = TimerScheduler("UiUpdates")
+        self.ui = UiUpdateChannel(self.ui_scheduler)
+        
+        # Config: an immutable AppConfig snapshot, replaced wholesale on change
+        self.config_writer = ConfigWriter(CONFIG_FILE)
+        self.config_lock = threading.Lock()  # Serializes read-modify-publish
+        self.config_poll_interval = 1.0  # Seconds between mtime checks for external edits
+        self.config_mtime_ns = None
+        self.config = AppConfig()
+        self.oauth = OAuthTokenClient()  # Endpoint follows config 'oauth_token_url'
+        self._publish_config(self.load_config())
+        self.saved_access_token = self.config.access_token
+        self.saved_refresh_token = self.config.refresh_token
+        self.token_expires_at = self.config.token_expires_at  # Unix time
+        self.token_refresh_at = self.config.token_refresh_at  # Unix time to refresh ahead of expiry
+        self.scheduler.call_later(self.config_poll_interval, self._watch_config)
+        
+        # Interned key names, looked up by pynput key object / vk
+        self._init_key_names()
+        
+        # Normalized chord -> [actions], rebuilt whenever bindings change
+        self.binding_table = {}
+        self.hold_table = {}  # key -> [(chord keys, chord, hold action)], most specific first
+        self.sequences = SequenceTrie()  # 'Chord, Chord, ...' bindings
+        self.relevant_keys = frozenset()  # Key names the hook prefilter lets through
+        self.prefiltered = 0  # Events dropped by the prefilter
+        self.active_holds = {}  # chord -> (chord keys, hold action) while held
+        self._rebuild_binding_table()
+        
+        # Macros (and media keys) run in order on one asyncio executor thread
+        self.actions = ActionExecutor(self)
+        
+        # Per-stage latency histograms (off unless enabled; see set_latency_tracing)
+        self.perf = LatencyHistograms()
+        
+        # Input trace being recorded, if any (see start_trace_recording)
+        self.trace_recorder = None
+        
+        # Hook callbacks only enqueue; one dispatcher thread does the matching
+        self.input_ring = InputEventRing()
+        self.dispatcher_thread = threading.Thread(
+            target=self._dispatch_loop, name="InputDispatcher", daemon=True)
+        self.dispatcher_thread.start()
+        
+        # Start input (benchmarks drive the handlers directly or use a synthetic source)
+        self.input_source = None
+        if start_listeners:
+            self.start_input(input_source or PynputInputSource())
+            
+            # Hooks can miss a key-up (lock screen, UAC prompt); recover from the OS state
+            if sys.platform == 'win32':
+                self.scheduler.call_later(self.key_resync_interval, self._resync_held_keys)
+    
+    def start_input(self, source):
+        """Switch to another InputSource (OS hooks, synthetic load, ...)"""
+        self.stop_input()
+        self.input_source = source
+        source.start(self)
+    
+    def stop_input(self):
+        source, self.input_source = self.input_source, None
+        if source:
+            try:
+                source.stop()
+            except Exception as e:
+                print(f"[ERROR] Failed to stop input source: {e}")
     
     def set_window(self, window):
         """Set the webview window reference"""
         self.window = window
         # Load config into UI
-        window.evaluate_js(f"loadConfig({json.dumps(self.config)})")
-        
-        # Auto-connect if credentials exist
-        if self.config.get('client_id') and self.config.get('client_secret'):
-            threading.Thread(target=self._delayed_connect, daemon=True).start()
+        self.ui.post('config', f"loadConfig({json.dumps(self.config.to_dict())})")
+        self.ui.attach(window)
+        self.auto_connect()
+    
+    def detach_window(self):
+        """Drop the window as a UI client; hooks and RPC keep running"""
+        window = self.window
+        self.window = None
+        self.ui.set_visible(False)
+        self.ui.attach(None)
+        return window
+    
+    def auto_connect(self, delay=1):
+        """Connect with saved credentials unless a connection is already running"""
+        if not self.running and self.config.client_id and self.config.client_secret:
+            self.scheduler.call_later(delay, self._delayed_connect)
     
     def _delayed_connect(self):
-        time.sleep(1)
-        self.connect(self.config.get('client_id'), self.config.get('client_secret'))
+        config = self.config
+        self.connect(config.client_id, config.client_secret)
+    
+    def _read_config_file(self):
+        """Read and validate config.json. Raises OSError/ValueError if unreadable"""
+        with open(CONFIG_FILE, 'r') as f:
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            data = json.load(f)
+        config, problems = AppConfig.from_dict(data)
+        for problem in problems:
+            print(f"[WARN] Ignoring invalid config value: {problem}")
+        self.config_mtime_ns = mtime_ns
+        return config
     
     def load_config(self):
         if os.path.exists(CONFIG_FILE):
             try:
-                with open(CONFIG_FILE, 'r') as f:
-                    return json.load(f)
-            except:
-                pass
-        return {}
+                return self._read_config_file()
+            except (OSError, ValueError) as e:
+                # Keep the unreadable file around instead of overwriting it on the next save
+                print(f"[ERROR] Failed to load config: {e}")
+                try:
+                    os.replace(CONFIG_FILE, CONFIG_FILE + '.corrupt')
+                except OSError:
+                    pass
+        return AppConfig()
+    
+    def _publish_config(self, config):
+        """Make a new snapshot current and recompile everything derived from it"""
+        self.config = config
+        self.combo_timeout = config.combo_timeout
+        self.long_press_threshold = config.long_press_threshold
+        # Read per request, so an edited endpoint applies from the next exchange / refresh
+        self.oauth.token_url = config.oauth_token_url or OAUTH_TOKEN_URL
+        self._rebuild_binding_table()
+    
+    def _update_config(self, changes):
+        """Publish a snapshot with `changes` (raw config keys) applied, without saving"""
+        with self.config_lock:
+            data = self.config.to_dict()
+            data.update(changes)
+            config, problems = AppConfig.from_dict(data)
+            for problem in problems:
+                print(f"[WARN] Ignoring invalid config value: {problem}")
+            self._publish_config(config)
+            return config
+    
+    def _watch_config(self):
+        """Hot-reload config.json when it is edited outside the app (runs on the scheduler)"""
+        try:
+            mtime_ns = os.stat(CONFIG_FILE).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        
+        writer = self.config_writer
+        if (mtime_ns is not None and mtime_ns != self.config_mtime_ns
+                and mtime_ns != writer.last_mtime_ns and not writer.pending):
+            try:
+                with self.config_lock:
+                    config = self._read_config_file()
+                    self._publish_config(config)
+                    self.saved_access_token = config.access_token
+                    self.saved_refresh_token = config.refresh_token
+                    self.token_expires_at = config.token_expires_at
+                    self.token_refresh_at = config.token_refresh_at
+                print("[DEBUG] Reloaded config.json after external change")
+                self.ui.post('config', f"loadConfig({json.dumps(config.to_dict())})")
+            except (OSError, ValueError) as e:
+                # Likely caught mid-save by an editor; keep the current snapshot and retry next tick
+                print(f"[WARN] Not reloading config: {e}")
+        
+        self.scheduler.call_later(self.config_poll_interval, self._watch_config)
     
     def has_config(self):
         """Check if config file exists - used for onboarding detection"""
@@ -113,18 +2082,18 @@ class DiscordAPI:
     
     def save_config(self, data=None):
         """Save config from UI"""
-        if data:
-            self.config.update(data)
+        changes = dict(data) if data else {}
         
         # Always include tokens
-        self.config['access_token'] = self.saved_access_token
-        self.config['refresh_token'] = self.saved_refresh_token
+        changes['access_token'] = self.saved_access_token
+        changes['refresh_token'] = self.saved_refresh_token
+        changes['token_expires_at'] = self.token_expires_at
+        changes['token_refresh_at'] = self.token_refresh_at
         
-        try:
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(self.config, f)
-        except:
-            pass
+        config = self._update_config(changes)
+        
+        # Written (debounced, atomically) by the ConfigWriter thread
+        self.config_writer.schedule(config.to_dict())
 
     def test_api(self):
         """Test if API is working"""
@@ -133,9 +2102,14 @@ class DiscordAPI:
 
     def close_window(self):
         """Close window - handle minimize to tray or actual close"""
-        print(f"[DEBUG] close_window called. minimize_to_tray={self.config.get('minimize_to_tray')}")
-        
-        if self.config.get('minimize_to_tray'):
+        print(f"[DEBUG] close_window called. minimize_to_tray={self.config.minimize_to_tray}")
+        
+        if self.headless:
+            # Headless: closing the window just detaches the UI (quit from the tray)
+            window = self.detach_window()
+            if window:
+                threading.Thread(target=window.destroy, daemon=True).start()
+        elif self.config.minimize_to_tray:
             # Minimize to tray instead of closing
             print("[DEBUG] Minimizing to tray...")
             if self.window:
@@ -151,24 +2125,17 @@ class DiscordAPI:
                 
                 # Give tray a moment to start, then hide
                 time.sleep(0.1)
+                self.ui.set_visible(False)
                 self.window.hide()
                 print("[DEBUG] Window hidden, tray should be running")
         else:
             # Actually close the application
             print("[DEBUG] Actually closing...")
             self.running = False
+            self.config_writer.flush()
             
             # Stop listeners immediately
-            try:
-                if self.mouse_listener:
-                    self.mouse_listener.stop()
-            except:
-                pass
-            try:
-                if self.keyboard_listener:
-                    self.keyboard_listener.stop()
-            except:
-                pass
+            self.stop_input()
             
             # Close asyncio loop
             if self.loop and self.loop.is_running():
@@ -204,6 +2171,7 @@ class DiscordAPI:
             exe_path = f'"{sys.executable}" "{os.path.abspath(sys.argv[0])}" --minimized'
 
         try:
+            import winreg
             key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, key_path, 0, winreg.KEY_ALL_ACCESS)
             if enabled:
                 winreg.SetValueEx(key, app_name, 0, winreg.REG_SZ, exe_path)
@@ -223,6 +2191,7 @@ class DiscordAPI:
         key_path = r"Software\Microsoft\Windows\CurrentVersion\Run"
         app_name = "DiscordMouseController"
         try:
+            import winreg
             key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, key_path, 0, winreg.KEY_READ)
             winreg.QueryValueEx(key, app_name)
             winreg.CloseKey(key)
@@ -252,17 +2221,17 @@ class DiscordAPI:
         return True
     
     def send_media_key(self):
-        """Send media play/pause key using Windows API"""
+        """Send media play/pause key using Windows API (via the action executor)"""
+        self.actions.submit('media', ACTION_MACROS['media'])
+    
+    async def press_media_key(self):
+        """Media play/pause: key down, key up 50ms later (action executor loop)"""
+        VK_MEDIA_PLAY_PAUSE = 0xB3
+        KEYEVENTF_EXTENDEDKEY = 0x0001
+        KEYEVENTF_KEYUP = 0x0002
         try:
-            # VK_MEDIA_PLAY_PAUSE = 0xB3
-            VK_MEDIA_PLAY_PAUSE = 0xB3
-            KEYEVENTF_EXTENDEDKEY = 0x0001
-            KEYEVENTF_KEYUP = 0x0002
-            
-            # Key down
             ctypes.windll.user32.keybd_event(VK_MEDIA_PLAY_PAUSE, 0, KEYEVENTF_EXTENDEDKEY, 0)
-            time.sleep(0.05)
-            # Key up
+            await asyncio.sleep(0.05)
             ctypes.windll.user32.keybd_event(VK_MEDIA_PLAY_PAUSE, 0, KEYEVENTF_EXTENDEDKEY | KEYEVENTF_KEYUP, 0)
             print("[DEBUG] Media key sent successfully")
         except Exception as e:
@@ -319,59 +2288,85 @@ class DiscordAPI:
         if not client_id or not client_secret:
             return
         
-        self.config['client_id'] = client_id
-        self.config['client_secret'] = client_secret
-        self.save_config()
+        self.save_config({'client_id': client_id, 'client_secret': client_secret})
         
         self.running = True
-        threading.Thread(target=self._run_rpc, args=(client_id, client_secret), daemon=True).start()
+        self.rpc_generation += 1
+        threading.Thread(target=self._run_rpc, args=(client_id, client_secret, self.rpc_generation),
+                         daemon=True).start()
     
     def disconnect(self):
         """Disconnect from Discord RPC"""
         self.running = False
+        if self.loop and self.rpc_client:
+            try:
+                self.loop.call_soon_threadsafe(self.rpc_client.close)
+            except RuntimeError:
+                pass
         self.update_connection_status(False)
         self.update_status("已斷開連接")
     
-    def _run_rpc(self, client_id, client_secret):
+    def get_rpc_metrics(self):
+        """Connection metrics"""
+        metrics = dict(self.rpc_metrics)
+        if self.rpc_client:
+            metrics.update(self.rpc_client.stats())
+        return metrics
+    
+    def _run_rpc(self, client_id, client_secret, generation):
         """Run the async RPC connection in a thread"""
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
-        
-        while self.running:
-            try:
-                self.loop.run_until_complete(self._async_main(client_id, client_secret))
-                if self.running:
-                    # Use verify async sleep to keep loop running!
-                    self.loop.run_until_complete(asyncio.sleep(2))
-            except Exception as e:
-                print(f"RPC Error: {e}")
-                if self.running:
-                    try:
-                        self.loop.run_until_complete(asyncio.sleep(2))
-                    except:
-                        time.sleep(2)
-                else:
-                    break
-    
-    async def _async_main(self, client_id, client_secret):
-        """Main async RPC logic"""
         try:
-            self.rpc_client = AioClient(client_id)
+            self.loop.run_until_complete(self._supervise(client_id, client_secret, generation))
+        except RuntimeError as e:
+            # loop.stop() from the close handlers ends run_until_complete early
+            print(f"RPC loop stopped: {e}")
+        except Exception as e:
+            print(f"[ERROR] RPC supervisor crashed: {e}")
+    
+    def _supervisor_active(self, generation):
+        return self.running and generation == self.rpc_generation
+    
+    async def _supervise(self, client_id, client_secret, generation):
+        """Keep the RPC connection up: capped exponential backoff with jitter,
+        and an immediate retry as soon as Discord's IPC endpoint reappears"""
+        backoff = Backoff()
+        # One client for the whole session; connect() opens a fresh pipe each time
+        client = self.rpc_client = DiscordIPC(client_id, self._on_rpc_message, self.frames.next_nonce)
+        lost_at = None
+        
+        while self._supervisor_active(generation):
+            was_connected = await self._async_main(client, client_id, client_secret, lost_at)
+            if not self._supervisor_active(generation):
+                break
             
-            # Connect with retries
-            self.update_status("正在連接 Discord...")
-            connected = False
-            for i in range(3):
-                try:
-                    await self.rpc_client.start()
-                    connected = True
-                    break
-                except Exception as e:
-                    print(f"Connection attempt {i+1} failed: {e}")
-                    await asyncio.sleep(1)
+            if was_connected:
+                lost_at = time.monotonic()
+                backoff.reset()
+            else:
+                self.rpc_metrics['failed_attempts'] += 1
             
-            if not connected:
-                raise Exception("無法連接到 Discord，請確認 Discord 已啟動")
+            if find_ipc_path():
+                # Discord is there but the attempt failed - back off
+                await asyncio.sleep(backoff.next_delay())
+            else:
+                # Discord closed / restarting: reconnect as soon as the endpoint is back
+                self.update_status("等待 Discord 啟動...")
+                while self._supervisor_active(generation) and not find_ipc_path():
+                    await asyncio.sleep(self.endpoint_poll_interval)
+    
+    async def _async_main(self, client, client_id, client_secret, lost_at=None):
+        """One connection: connect, authenticate, serve until the pipe closes; True if it was established"""
+        established = False
+        refresher = None
+        sender = None
+        try:
+            self.update_status("正在連接 Discord...")
+            try:
+                await client.connect()
+            except Exception as e:
+                raise Exception(f"無法連接到 Discord，請確認 Discord 已啟動 ({e})")
             
             # Auth
             access_token = self.saved_access_token
@@ -383,7 +2378,7 @@ class DiscordAPI:
                 for auth_attempt in range(max_auth_attempts):
                     try:
                         self.update_status(f"請在 Discord 視窗中點擊授權... (嘗試 {auth_attempt + 1}/{max_auth_attempts})")
-                        auth_resp = await self.rpc_client.authorize(client_id, scopes=['rpc'])
+                        auth_resp = await client.authorize(client_id, scopes=['rpc'])
                         code = auth_resp['data']['code']
                         
                         # Exchange immediately to avoid code expiration
@@ -392,32 +2387,13 @@ class DiscordAPI:
                         # Debug: print what we're sending (hide secret)
                         print(f"[DEBUG] Token exchange - client_id: {client_id[:8]}..., secret_len: {len(client_secret)}")
                         
-                        token_resp = requests.post(
-                            'https://discord.com/api/oauth2/token',
-                            data={
-                                'client_id': client_id,
-                                'client_secret': client_secret,
-                                'grant_type': 'authorization_code',
-                                'code': code,
-                                'redirect_uri': 'http://127.0.0.1'
-                            },
-                            headers={
-                                'Content-Type': 'application/x-www-form-urlencoded'
-                            },
-                            timeout=10
-                        )
-                        
-                        if token_resp.status_code == 200:
-                            token_data = token_resp.json()
-                            access_token = token_data['access_token']
-                            refresh_token = token_data.get('refresh_token')
-                            
-                            self.saved_access_token = access_token
-                            self.saved_refresh_token = refresh_token
-                            self.save_config()
+                        try:
+                            token_data = await self.oauth.exchange_code(client_id, client_secret, code)
+                            access_token = self._store_tokens(token_data)
+                            refresh_token = self.saved_refresh_token
                             break  # Success, exit retry loop
-                        else:
-                            error_text = token_resp.text
+                        except OAuthError as token_error:
+                            error_text = token_error.text
                             print(f"Token exchange attempt {auth_attempt + 1} failed: {error_text}")
                             
                             # Check for specific errors
@@ -437,53 +2413,65 @@ class DiscordAPI:
                         else:
                             raise
             
+            # Refresh first if the stored token is already (about to be) expired
+            elif refresh_token and self.token_expires_at and time.time() >= self.token_expires_at - 60:
+                self.update_status("Token 即將過期，正在刷新...")
+                try:
+                    access_token = await self._refresh_tokens(client_id, client_secret)
+                except Exception as refresh_error:
+                    print(f"Token refresh failed: {refresh_error}")
+            
             # Authenticate
             self.update_status("驗證中...")
             try:
-                await self.rpc_client.authenticate(access_token)
+                await client.authenticate(access_token)
             except Exception as auth_error:
                 print(f"Auth failed: {auth_error}")
                 
                 # Try refresh
                 if refresh_token:
                     self.update_status("Token 已過期，正在刷新...")
-                    refresh_resp = requests.post(
-                        'https://discord.com/api/oauth2/token',
-                        data={
-                            'client_id': client_id,
-                            'client_secret': client_secret,
-                            'grant_type': 'refresh_token',
-                            'refresh_token': refresh_token
-                        }
-                    )
-                    
-                    if refresh_resp.status_code == 200:
-                        token_data = refresh_resp.json()
-                        access_token = token_data['access_token']
-                        refresh_token = token_data.get('refresh_token', refresh_token)
-                        
-                        self.saved_access_token = access_token
-                        self.saved_refresh_token = refresh_token
-                        self.save_config()
-                        
-                        await self.rpc_client.authenticate(access_token)
-                    else:
+                    try:
+                        access_token = await self._refresh_tokens(client_id, client_secret)
+                    except OAuthError:
                         # Need full re-auth
                         self.saved_access_token = None
                         self.saved_refresh_token = None
+                        self.token_expires_at = None
+                        self.token_refresh_at = None
                         self.save_config()
                         raise Exception("驗證失敗，請重新連接")
+                    
+                    await client.authenticate(access_token)
                 else:
                     raise auth_error
             
             # Subscribe to voice updates
-            await self.rpc_client.subscribe('VOICE_SETTINGS_UPDATE')
+            await client.subscribe('VOICE_SETTINGS_UPDATE')
+            
+            if self.rpc_client is not client:
+                return False  # Superseded while authorizing
+            
+            # From here on every outgoing frame goes through the single writer
+            sender = self._start_sender(client)
+            established = True
+            refresher = asyncio.ensure_future(self._token_refresh_loop(client_id, client_secret))
+            
+            self.rpc_metrics['connects'] += 1
+            if lost_at is not None:
+                elapsed = time.monotonic() - lost_at
+                self.rpc_metrics['reconnects'] += 1
+                self.rpc_metrics['last_reconnect_s'] = elapsed
+                self.rpc_metrics['max_reconnect_s'] = max(elapsed, self.rpc_metrics['max_reconnect_s'] or 0)
+                print(f"[DEBUG] Reconnected in {elapsed:.3f}s")
             
             self.update_status("已連接")
             self.update_connection_status(True)
             
-            # Read loop
-            await self._read_loop()
+            # Responses and dispatches arrive via _on_rpc_message until the pipe closes
+            reason = await client.wait_closed()
+            if self.running:
+                print(f"RPC connection closed: {reason}")
             
         except Exception as e:
             print(f"Error: {e}")
@@ -496,176 +2484,451 @@ class DiscordAPI:
                 except:
                     pass
         finally:
-            if self.rpc_client and hasattr(self.rpc_client, 'sock_writer'):
-                try:
-                    self.rpc_client.sock_writer.close()
-                except:
-                    pass
+            # A newer supervisor may already own rpc_client / rpc_sender
+            if refresher:
+                refresher.cancel()
+            if sender:
+                sender.close()
+                if self.rpc_sender is sender:
+                    self.rpc_sender = None
+            if self.rpc_client is client:
+                self.voice_state.reset()
+            client.close()
+        return established
+    
+    def _store_tokens(self, token_data):
+        """Persist a token endpoint answer; returns the new access token"""
+        self.saved_access_token = token_data['access_token']
+        self.saved_refresh_token = token_data.get('refresh_token', self.saved_refresh_token)
+        expires_in = token_data.get('expires_in')
+        if expires_in:
+            now = time.time()
+            self.token_expires_at = now + expires_in
+            # Refresh an hour ahead (Discord tokens last days), or halfway for short-lived ones
+            self.token_refresh_at = now + max(expires_in - 3600, expires_in / 2)
+        else:
+            self.token_expires_at = None
+            self.token_refresh_at = None
+        self.save_config()
+        return self.saved_access_token
     
-    async def _read_loop(self):
-        """Read discord events"""
-        while self.running:
+    async def _refresh_tokens(self, client_id, client_secret):
+        token_data = await self.oauth.refresh(client_id, client_secret, self.saved_refresh_token)
+        print("[DEBUG] Access token refreshed")
+        return self._store_tokens(token_data)
+    
+    async def _token_refresh_loop(self, client_id, client_secret):
+        """Refresh the token in the background ahead of expiry while connected"""
+        while self.saved_refresh_token and self.token_refresh_at:
+            delay = self.token_refresh_at - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
             try:
-                data = await self.rpc_client.read_output()
-                
-                if data.get('cmd') == 'DISPATCH' and data.get('evt') == 'VOICE_SETTINGS_UPDATE':
-                    payload = data.get('data', {})
-                    self.current_voice_settings['deaf'] = payload.get('deaf', False)
-                    self.current_voice_settings['mute'] = payload.get('mute', False)
-                    self.update_voice_status()
-                    
+                await self._refresh_tokens(client_id, client_secret)
             except Exception as e:
-                if "timed out" in str(e) or "No response" in str(e):
-                    continue
-                print(f"Read error: {e}")
-                break
+                print(f"Background token refresh failed: {e}")
+                await asyncio.sleep(60)
     
-    async def _toggle_deaf(self):
-        """Toggle deafen status"""
-        try:
-            new_deaf = not self.current_voice_settings['deaf']
-            payload = {
-                'cmd': 'SET_VOICE_SETTINGS',
-                'args': {'deaf': new_deaf},
-                'nonce': str(time.time())
-            }
-            await self._send_payload(1, payload)
-        except Exception as e:
-            print(f"Toggle deaf error: {e}")
+    def _on_rpc_message(self, data):
+        """Handle frames from Discord that no command is waiting for (RPC loop thread)"""
+        cmd = data.get('cmd')
+        if cmd == 'DISPATCH':
+            if data.get('evt') == 'VOICE_SETTINGS_UPDATE':
+                self.voice_state.confirm(data.get('data') or {})
+                self.update_voice_status()
+        elif cmd == 'SET_VOICE_SETTINGS' and data.get('nonce'):
+            if self.perf.enabled:
+                self.perf.record_since(data['nonce'], 'ack')
+            if data.get('evt') == 'ERROR':
+                # Discord rejected one of our toggles - revert it now
+                print(f"Discord error: {(data.get('data') or {}).get('message')}")
+                self.voice_state.discard(data['nonce'])
+            else:
+                # Response to one of our toggles - reconcile with real state
+                self.voice_state.acknowledge(data['nonce'], data.get('data'))
+            self.update_voice_status()
+    
+    def _start_sender(self, client):
+        """Create and publish the writer task for client's connection (on its loop)"""
+        sender = RpcSender(client.loop, client, self.frames, perf=self.perf)
+        sender.start()
+        self.rpc_sender = sender
+        return sender
+    
+    def send_voice_setting(self, field, value, nonce=None):
+        """Queue SET_VOICE_SETTINGS for one field; returns (nonce, Future)"""
+        if nonce is None:
+            nonce = self.frames.next_nonce()
+        # Queued frames for the same field merge - only the latest value is sent
+        future = self.send_payload(1, (field, value, nonce),
+                                   merge_key=('SET_VOICE_SETTINGS', field))
+        return nonce, future
+    
+    def toggle_voice_setting(self, field):
+        """Optimistically flip 'mute' / 'deaf' and send it; returns the Future"""
+        return self.set_voice_settings({field: None})
+    
+    def set_voice_settings(self, changes):
+        """Optimistically apply {'mute' / 'deaf': True, False or None (flip)}
+        and send it as one SET_VOICE_SETTINGS frame; returns the Future"""
+        nonce = self.frames.next_nonce()
+        resolved = self.voice_state.apply(changes, nonce)
+        
+        if len(resolved) == 1:
+            (field, value), = resolved.items()
+            _, future = self.send_voice_setting(field, value, nonce)
+        else:
+            # Merged macro steps: single-field frames queued later must not jump it
+            future = self.send_payload(1, {
+                'cmd': 'SET_VOICE_SETTINGS', 'args': resolved, 'nonce': nonce
+            }, barrier=tuple(('SET_VOICE_SETTINGS', field) for field in resolved))
+        # Frame is queued; the UI and tray follow
+        self.update_voice_status()
+        
+        def settle(fut):
+            # Merged away (False) or failed: this nonce will never be answered
+            if fut.exception() is not None or fut.result() is False:
+                if self.voice_state.discard(nonce):
+                    self.update_voice_status()
+            else:
+                self.scheduler.call_later(self.pending_timeout, self._expire_voice_command, nonce)
+        
+        future.add_done_callback(settle)
+        return future
     
-    async def _toggle_mute(self):
-        """Toggle mute status"""
-        try:
-            new_mute = not self.current_voice_settings['mute']
-            payload = {
-                'cmd': 'SET_VOICE_SETTINGS',
-                'args': {'mute': new_mute},
-                'nonce': str(time.time())
-            }
-            await self._send_payload(1, payload)
-        except Exception as e:
-            print(f"Toggle mute error: {e}")
+    def _expire_voice_command(self, nonce):
+        if self.voice_state.discard(nonce):
+            print(f"[DEBUG] No response for voice command {nonce}, reverting")
+            self.update_voice_status()
     
-    async def _send_payload(self, op, payload):
-        """Send raw payload to Discord"""
-        try:
-            payload_json = json.dumps(payload)
-            encoded = payload_json.encode('utf-8')
-            header = struct.pack('<II', op, len(encoded))
-            
-            if hasattr(self.rpc_client, 'sock_writer'):
-                self.rpc_client.sock_writer.write(header + encoded)
-                await self.rpc_client.sock_writer.drain()
-        except:
-            pass
+    def send_payload(self, op, payload, merge_key=None, barrier=()):
+        """Queue a raw payload for Discord from any thread; returns a Future"""
+        sender = self.rpc_sender
+        if sender is None:
+            future = concurrent.futures.Future()
+            future.set_exception(ConnectionError("RPC not connected"))
+            return future
+        return sender.submit(op, payload, merge_key, barrier)
     
     # === Input Handlers ===
     
+    # Display names for pynput key / button names (lowercase, without the "Key." prefix)
+    KEY_NAMES = {
+        'ctrl_l': 'Ctrl', 'ctrl_r': 'Ctrl', 'ctrl': 'Ctrl',
+        'shift_l': 'Shift', 'shift_r': 'Shift', 'shift': 'Shift',
+        'alt_l': 'Alt', 'alt_r': 'Alt', 'alt': 'Alt', 'alt_gr': 'Alt',
+        'cmd': 'Win', 'cmd_l': 'Win', 'cmd_r': 'Win',
+        'space': 'Space', 'enter': 'Enter', 'esc': 'Esc',
+        'tab': 'Tab', 'backspace': 'Backspace',
+        'up': '↑', 'down': '↓', 'left': '←', 'right': '→',
+        'f1': 'F1', 'f2': 'F2', 'f3': 'F3', 'f4': 'F4',
+        'f5': 'F5', 'f6': 'F6', 'f7': 'F7', 'f8': 'F8',
+        'f9': 'F9', 'f10': 'F10', 'f11': 'F11', 'f12': 'F12',
+    }
+    BUTTON_NAMES = {'left': 'LMB', 'right': 'RMB', 'middle': 'MMB',
+                    'x1': 'Mouse4', 'x2': 'Mouse5'}
+    MODIFIER_NAMES = ('Ctrl', 'Alt', 'Shift', 'Win')
+    
+    def _init_key_names(self):
+        """Precompute interned names for every Key / Button; KeyCodes fill in lazily"""
+        self._key_names = {}  # keyboard.Key / mouse.Button member -> name
+        self._keycode_names = {}  # (KeyCode.vk, KeyCode.char) -> name
+        for member in itertools.chain(keyboard.Key, mouse.Button):
+            self._key_names[member] = sys.intern(self._normalize_key(str(member)))
+    
+    def _key_name(self, key):
+        """Display name for a pynput key or button: one dict lookup once seen"""
+        if type(key) is keyboard.KeyCode:
+            # Keyed on the char too: other VKs name whatever char the press
+            # produced, which modifiers change (Shift+, is '<')
+            cache_key = (key.vk, key.char)
+            name = self._keycode_names.get(cache_key)
+            if name is None:
+                vk = key.vk
+                # Windows letter / digit VKs are their ASCII codes, whatever
+                # char modifiers produced (Ctrl+M arrives as '\r')
+                if vk is not None and sys.platform == 'win32' and (0x30 <= vk <= 0x39 or 0x41 <= vk <= 0x5A):
+                    name = chr(vk)
+                else:
+                    name = self._normalize_key(str(key))
+                name = self._keycode_names[cache_key] = sys.intern(name)
+            return name
+        
+        name = self._key_names.get(key)
+        if name is None:
+            name = self._key_names[key] = sys.intern(self._normalize_key(str(key)))
+        return name
+    
     def _normalize_key(self, key_str):
-        """Normalize key names for cleaner display"""
+        """Normalize a pynput key string for display (slow path for _key_name)"""
         # Remove Key. prefix and clean up
         clean = key_str.replace("Key.", "").replace("'", "")
         
-        # Normalize common keys
-        normalizations = {
-            'ctrl_l': 'Ctrl', 'ctrl_r': 'Ctrl', 'ctrl': 'Ctrl',
-            'shift_l': 'Shift', 'shift_r': 'Shift', 'shift': 'Shift',
-            'alt_l': 'Alt', 'alt_r': 'Alt', 'alt': 'Alt', 'alt_gr': 'Alt',
-            'cmd': 'Win', 'cmd_l': 'Win', 'cmd_r': 'Win',
-            'space': 'Space', 'enter': 'Enter', 'esc': 'Esc',
-            'tab': 'Tab', 'backspace': 'Backspace',
-            'up': '↑', 'down': '↓', 'left': '←', 'right': '→',
-            'f1': 'F1', 'f2': 'F2', 'f3': 'F3', 'f4': 'F4',
-            'f5': 'F5', 'f6': 'F6', 'f7': 'F7', 'f8': 'F8',
-            'f9': 'F9', 'f10': 'F10', 'f11': 'F11', 'f12': 'F12',
-        }
-        
         lower_clean = clean.lower()
-        if lower_clean in normalizations:
-            return normalizations[lower_clean]
+        if lower_clean in self.KEY_NAMES:
+            return self.KEY_NAMES[lower_clean]
         
         # For mouse buttons
         if 'Button.' in key_str:
             button_name = key_str.replace('Button.', '')
-            button_map = {'left': 'LMB', 'right': 'RMB', 'middle': 'MMB', 
-                         'x1': 'Mouse4', 'x2': 'Mouse5'}
-            return button_map.get(button_name, button_name)
+            return self.BUTTON_NAMES.get(button_name, button_name)
         
         # Return uppercase single char or as-is
         if len(clean) == 1:
             return clean.upper()
         return clean
     
+    # Windows virtual-key codes for names that don't map to one pynput vk
+    OS_VKS = {
+        'Ctrl': (0x11,), 'Shift': (0x10,), 'Alt': (0x12,), 'Win': (0x5B, 0x5C),
+        'LMB': (0x01,), 'RMB': (0x02,), 'MMB': (0x04,), 'Mouse4': (0x05,), 'Mouse5': (0x06,),
+    }
+    
+    def _os_vks(self, name, key):
+        """Virtual-key codes the OS reports for a held key name (for resync)"""
+        vks = self.OS_VKS.get(name)
+        if vks is not None:
+            return vks
+        vk = getattr(getattr(key, 'value', key), 'vk', None)
+        return (vk,) if vk else ()
+    
+    # --- Hook callbacks: run on the OS hook threads, only timestamp and enqueue ---
+    
     def on_key_press(self, key):
-        key_str = str(key)
-        normalized = self._normalize_key(key_str)
-        current_time = time.time()
+        if self._prefilter(key, False):
+            return
+        self.input_ring.push(InputEventRing.KEY_PRESS, key, time.perf_counter_ns())
+    
+    def on_key_release(self, key):
+        if self._prefilter(key, True):
+            return
+        self.input_ring.push(InputEventRing.KEY_RELEASE, key, time.perf_counter_ns())
+    
+    def on_click(self, x, y, button, pressed):
+        if self._prefilter(button, not pressed):
+            return
+        kind = InputEventRing.MOUSE_PRESS if pressed else InputEventRing.MOUSE_RELEASE
+        self.input_ring.push(kind, button, time.perf_counter_ns())
+    
+    def feed_input(self, kind, key, t_ns):
+        """Inject one event stamped t_ns, as if the hooks had seen it (synthetic sources)"""
+        release = kind == InputEventRing.KEY_RELEASE or kind == InputEventRing.MOUSE_RELEASE
+        if self._prefilter(key, release):
+            return False
+        return self.input_ring.push(kind, key, t_ns)
+    
+    def _prefilter(self, key, release):
+        """Fast reject on the hook thread: True if the event can't matter"""
+        # Class lookup skips the latency-tracing wrapper (dispatcher-only stats)
+        name = DiscordAPI._key_name(self, key)
+        if name in self.relevant_keys:
+            return False
+        if release and name in self.held:
+            return False  # Let a key held from before a bindings change come up
+        if self.binding_target or self.binding_pending or self.trace_recorder is not None:
+            return False
+        sequences = self.sequences
+        if sequences.node is not sequences.root or self._last_input_live():
+            return False
+        self.prefiltered += 1
+        return True
+    
+    def _last_input_live(self):
+        """Mirror inputs to the UI only when enabled and someone can see it"""
+        return self.config.show_last_input and self.ui.visible and self.ui.window is not None
+    
+    def get_input_stats(self):
+        """Input queue counters"""
+        ring = self.input_ring
+        return {
+            'pushed': ring.pushed,
+            'processed': ring.processed,
+            'dropped': ring.dropped,
+            'capacity': ring.capacity,
+            'prefiltered': self.prefiltered,
+        }
+    
+    # --- Latency tracing ---
+    
+    # Dispatcher-stage methods that get a timing wrapper while tracing is on
+    TRACED_METHODS = {
+        '_key_name': 'normalize',
+        '_build_combo_string_from_list': 'combo',
+        '_check_and_trigger': 'trigger',
+    }
+    
+    def set_latency_tracing(self, enabled):
+        """Turn per-stage latency histograms on or off"""
+        enabled = bool(enabled)
+        if enabled == self.perf.enabled:
+            return enabled
+        for name, stage in self.TRACED_METHODS.items():
+            if enabled:
+                setattr(self, name, self._timed(getattr(type(self), name).__get__(self), stage))
+            else:
+                # Drop the instance wrapper; the plain method costs nothing extra
+                self.__dict__.pop(name, None)
+        self.perf.enabled = enabled
+        return enabled
+    
+    def _timed(self, method, stage):
+        record = self.perf.record
+        perf_counter_ns = time.perf_counter_ns
+        
+        def timed(*args):
+            start = perf_counter_ns()
+            try:
+                return method(*args)
+            finally:
+                record(stage, perf_counter_ns() - start)
+        return timed
+    
+    def get_latency_histograms(self):
+        """Per-stage latency histograms"""
+        return {'enabled': self.perf.enabled, 'stages': self.perf.snapshot()}
+    
+    def reset_latency_histograms(self):
+        self.perf.reset()
+    
+    def dump_latency_histograms(self, path=None):
+        """Write the histograms as JSON (default: next to config.json); returns the path"""
+        path = path or os.path.join(os.path.dirname(CONFIG_FILE), "latency_histograms.json")
+        try:
+            return self.perf.dump(path)
+        except OSError as e:
+            print(f"[ERROR] Failed to dump latency histograms: {e}")
+            return None
+    
+    # --- Input trace recording ---
+    
+    def start_trace_recording(self, path):
+        """Record every dispatched input event to a binary trace at path"""
+        self.stop_trace_recording()
+        try:
+            self.trace_recorder = InputTraceWriter(path)
+        except OSError as e:
+            print(f"[ERROR] Failed to start trace recording: {e}")
+            return False
+        print(f"[DEBUG] Recording input trace to {path}")
+        return True
+    
+    def stop_trace_recording(self):
+        """Stop recording; returns the number of events written"""
+        recorder, self.trace_recorder = self.trace_recorder, None
+        if recorder is None:
+            return 0
+        # Let the dispatcher finish any batch it is writing
+        self.input_ring.wait_idle(1)
+        recorder.close()
+        return recorder.events
+    
+    # --- Held-key resync: a missed key-up must not leave a key stuck forever ---
+    
+    def _resync_held_keys(self):
+        """Scheduler callback: ask the OS which held keys are really still down"""
+        try:
+            state = self.held.snapshot()
+            if state[1]:
+                get_key_state = ctypes.windll.user32.GetAsyncKeyState
+                if self.held.stale(state, lambda vk: get_key_state(vk) & 0x8000):
+                    # Released on the dispatcher, which stays the only writer
+                    self.input_ring.push(InputEventRing.RESYNC, state, time.perf_counter_ns())
+        finally:
+            self.scheduler.call_later(self.key_resync_interval, self._resync_held_keys)
+    
+    def _drop_stale_keys(self, state):
+        """Dispatcher side of the resync: release keys the OS reported as up"""
+        held = self.held
+        if held.snapshot() is not state:
+            return  # Input arrived since the check; the next resync will see it
+        get_key_state = ctypes.windll.user32.GetAsyncKeyState
+        for name in held.stale(state, lambda vk: get_key_state(vk) & 0x8000):
+            print(f"[DEBUG] Dropping stuck key: {name}")
+            held.release(name)
+            if self.active_holds:
+                self._release_holds(name)
+    
+    # --- Dispatcher: everything below runs on the single dispatcher thread ---
+    
+    def _dispatch_loop(self):
+        ring = self.input_ring
+        perf = self.perf
+        while True:
+            batch = ring.pop_all()
+            if batch is None:
+                return
+            recorder = self.trace_recorder
+            for kind, key, t_ns in batch:
+                if perf.enabled:
+                    perf.record('hook', time.perf_counter_ns() - t_ns)
+                try:
+                    if kind == InputEventRing.RESYNC:
+                        self._drop_stale_keys(key)
+                        continue
+                    if kind == InputEventRing.LONG_PRESS:
+                        if key == self.first_key_press_time:  # not reset/re-armed since
+                            self.long_press_timer = None
+                            self._on_long_press(self.pending_combo)
+                        continue
+                    if recorder is not None:
+                        recorder.record(kind, key, t_ns)
+                    if kind == InputEventRing.KEY_PRESS:
+                        self._handle_key_press(key, t_ns)
+                    elif kind == InputEventRing.KEY_RELEASE:
+                        self._handle_key_release(key, t_ns)
+                    else:
+                        self._handle_click(key, kind == InputEventRing.MOUSE_PRESS, t_ns)
+                except Exception as e:
+                    print(f"[ERROR] Input dispatch failed: {e}")
+            ring.task_done(len(batch))
+    
+    def _handle_key_press(self, key, t_ns):
+        normalized = self._key_name(key)
+        current_time = t_ns / 1e9
         
         # If in binding mode
         if self.binding_target:
-            # Add to pressed keys if not present
-            if normalized not in self.pressed_keys:
-                self.pressed_keys.append(normalized)
+            held = self.held
+            held.press(normalized, key)
             
             # If this is the first key pressed, start long press timer
-            if len(self.pressed_keys) == 1 and self.first_key_press_time is None:
-                self.first_key_press_time = current_time
-                self.pending_combo = normalized
-                self.long_press_active = False
-                
-                # Start a timer to detect long press
-                def long_press_check():
-                    time.sleep(self.long_press_threshold)
-                    # Check if still pressing the same key
-                    if self.binding_target and normalized in self.pressed_keys:
-                        self.long_press_active = True
-                        self.pending_combo = normalized
-                        if self.window:
-                            try:
-                                self.window.evaluate_js(f"updateStatus('已鎖定 {normalized}，請按第二個按鍵...')")
-                            except:
-                                pass
-                        print(f"[DEBUG] Long press detected: {normalized}, waiting for second key...")
-                
-                self.long_press_timer = threading.Thread(target=long_press_check, daemon=True)
-                self.long_press_timer.start()
+            if len(held) == 1 and self.first_key_press_time is None:
+                self._start_long_press(normalized, current_time)
                 
-            elif len(self.pressed_keys) >= 2 and self.long_press_active:
+            elif len(held) >= 2 and self._long_press_reached(current_time):
                 # Second key pressed during long press mode - create combo
-                # Build combo with both keys - using list order
-                combo = self._build_combo_string_from_list(self.pressed_keys)
+                # Build combo with both keys - using press order
+                combo = self._build_combo_string_from_list(held.held_names())
                 self.pending_combo = combo
                 print(f"[DEBUG] Combo key detected: {combo}")
-                if self.window:
-                    try:
-                        self.window.evaluate_js(f"updateStatus('組合鍵: {combo}')")
-                    except:
-                        pass
+                self.update_status(f"組合鍵: {combo}")
             return
         
-        # Normal mode - add to pressed keys and track for release
-        if normalized not in self.pressed_keys:
-            self.pressed_keys.append(normalized)
+        # Normal mode - add to held keys and track for release
+        self.held.press(normalized, key)
         self.last_key_time = current_time
+        self.stroke_open = True
+        
+        # Hold bindings (push-to-talk / push-to-mute) fire on the press edge
+        if normalized in self.hold_table:
+            self._press_holds(normalized)
     
-    def on_key_release(self, key):
-        key_str = str(key)
-        normalized = self._normalize_key(key_str)
+    def _handle_key_release(self, key, t_ns):
+        normalized = self._key_name(key)
         
         # If in binding mode and a key was released
         if self.binding_target:
             # ESC cancels binding
             if normalized == 'Esc':
                 self._cancel_binding()
-                self.pressed_keys.clear()
+                self.held.clear()
                 self._reset_long_press_state()
                 return
             
             # When all keys are released, complete the binding
-            if normalized in self.pressed_keys:
-                self.pressed_keys.remove(normalized)
+            self.held.release(normalized)
                 
-            if len(self.pressed_keys) == 0 and self.pending_combo:
+            if len(self.held) == 0 and self.pending_combo:
                 # Complete binding with the pending combo
                 self._complete_binding(self.pending_combo)
                 self._reset_long_press_state()
@@ -675,19 +2938,21 @@ class DiscordAPI:
         # We check the combo formed by (keys still held) + (key being released)
         # This allows "Hold A, Press B, Release B" to trigger "A+B"
         
-        if normalized not in self.pressed_keys:
-            self.pressed_keys.append(normalized)
+        held = self.held
+        keys = held.held_names()
+        if normalized not in held:
+            keys.append(normalized)
         
-        # Build combo string for this moment
-        # Note: pressed_keys is now a list, so order is preserved
-        combo_to_check = self._build_combo_string_from_list(self.pressed_keys)
+        # Build combo string for this moment (press order is preserved)
+        combo_to_check = self._build_combo_string_from_list(keys)
         
         # Check against config and trigger
-        triggered = self._check_and_trigger(combo_to_check)
+        triggered = self._check_and_trigger(combo_to_check, t_ns / 1e9)
         
-        # Remove from pressed keys
-        if normalized in self.pressed_keys:
-            self.pressed_keys.remove(normalized)
+        # Remove from held keys
+        held.release(normalized)
+        if self.active_holds:
+            self._release_holds(normalized)
     
     def _build_combo_string_from_list(self, key_list):
         """Build combo string from a list of keys, preserving order for non-modifiers"""
@@ -714,44 +2979,182 @@ class DiscordAPI:
         # Combine: Modifiers first, then others (in original press order)
         final_list = modifiers + others
         
-        return '+'.join(final_list[:2])
+        return '+'.join(final_list)
 
     def _build_combo_string(self):
-        """Build a combo string from currently pressed keys (max 2 keys)"""
-        return self._build_combo_string_from_list(self.pressed_keys)
+        """Build a combo string from currently held keys"""
+        return self._build_combo_string_from_list(self.held.held_names())
+        
+    def _normalize_chord(self, chord):
+        """Normalize a stored chord string (e.g. 'm+Ctrl') to combo string form"""
+        if not chord or not isinstance(chord, str):
+            return ""
+        keys = [k.strip() for k in chord.split('+') if k.strip()]
+        # Single characters are stored uppercase, same as _key_name
+        keys = [k.upper() if len(k) == 1 else k for k in keys]
+        return self._build_combo_string_from_list(keys)
+
+    def _normalize_sequence(self, spec):
+        """Normalize a binding spec into its strokes: 'Mouse5, m' -> ('Mouse5', 'M')"""
+        if not spec or not isinstance(spec, str):
+            return ()
+        return tuple(filter(None, (self._normalize_chord(part) for part in spec.split(','))))
+
+    def _rebuild_binding_table(self):
+        """Compile btn_<action> and bindings into the chord table and sequence trie"""
+        table = {}
+        hold_table = {}
+        sequences = SequenceTrie()
+        # Keys that can take part in a binding; the hook drops everything else.
+        # Modifiers always count: they tell 'M' apart from 'Ctrl+M'.
+        relevant = set(self.MODIFIER_NAMES)
+        
+        def add(chord, action):
+            strokes = self._normalize_sequence(chord)
+            if not strokes:
+                return
+            for stroke in strokes:
+                relevant.update(stroke.split('+'))
+            if len(strokes) > 1:
+                if action in HOLD_ACTIONS:
+                    print(f"[WARN] Hold action {action} can't use a sequence: {chord}")
+                    return
+                sequences.add(strokes, action)
+                return
+            key = strokes[0]
+            if action in HOLD_ACTIONS:
+                # Indexed by every key of the chord: whichever goes down last fires it
+                required = tuple(key.split('+'))
+                for part in required:
+                    entries = hold_table.setdefault(part, [])
+                    if (required, key, action) not in entries:
+                        entries.append((required, key, action))
+                return
+            actions = table.setdefault(key, [])
+            if action not in actions:
+                actions.append(action)
+        
+        config = self.config
+        for action, chord in config.buttons.items():
+            add(chord, action)
         
-    def _check_and_trigger(self, combo_id):
-        """Check if a combo is bound and trigger it"""
+        for action, chords in config.bindings.items():
+            for chord in chords:
+                add(chord, action)
+        
+        # Most specific chord first, so Ctrl+Mouse4 wins over Mouse4
+        for entries in hold_table.values():
+            entries.sort(key=lambda entry: -len(entry[0]))
+        
+        sequences.compile()
+        
+        # Swap in one assignment so listener threads never see a partial table
+        self.binding_table = table
+        self.hold_table = hold_table
+        self.sequences = sequences
+        self.relevant_keys = frozenset(relevant)
+
+    def _press_holds(self, key):
+        """key went down: start the most specific hold binding whose keys are all held.
+        Other held keys (heavy typing) don't stop a match."""
+        held = self.held
+        matched = None
+        for required, chord, action in self.hold_table[key]:
+            if matched is not None and len(required) < matched:
+                break
+            if chord in self.active_holds or not all(k in held for k in required):
+                continue
+            matched = len(required)
+            self.active_holds[chord] = (required, action)
+            self._set_hold(action, True)
+    
+    def _release_holds(self, key):
+        """key went up: end every active hold binding that included it"""
+        for chord, (required, action) in list(self.active_holds.items()):
+            if key in required:
+                del self.active_holds[chord]
+                self._set_hold(action, False)
+    
+    def _set_hold(self, action, held):
+        if not self.rpc_sender:
+            print("[API] Cannot trigger action: RPC not connected")
+            return
+        # ptt: unmuted while held; ptm: muted while held
+        self.set_voice_settings({'mute': HOLD_ACTIONS[action] if held else not HOLD_ACTIONS[action]})
+    
+    def _check_and_trigger(self, combo_id, released_at=0.0):
+        """Check if a combo (or the sequence it completes) is bound and trigger it"""
         if not combo_id:
             return False
             
-        # Update UI with last input for visual feedback
-        if self.window:
-            try:
-                # Only update simple inputs or if actually bound to avoid spamming UI
-                # But for debugging, showing everything is helpful
-                safe_input = json.dumps(combo_id)
-                self.window.evaluate_js(f"updateLastInput({safe_input})")
-            except:
-                pass
+        # Update UI with last input for visual feedback (coalesced per frame)
+        if self._last_input_live():
+            self.ui.post('last_input', f"updateLastInput({json.dumps(combo_id)})")
+        
+        # Multi-stroke sequences advance once per chord: on its first key-up, and
+        # only if it has a non-modifier key. Letting go of Ctrl after Ctrl+K (or
+        # of K after Ctrl) must not count as another stroke.
+        sequences = self.sequences
+        completed = ()
+        if sequences and self.stroke_open:
+            self.stroke_open = False
+            if combo_id.rpartition('+')[2] not in self.MODIFIER_NAMES:
+                completed = sequences.advance(combo_id, self.last_key_time, released_at, self.combo_timeout)
                 
         # Check bindings
-        triggered = False
-        if combo_id == self.config.get('btn_media'):
-            self.trigger_action('media')
-            triggered = True
-        
-        if combo_id == self.config.get('btn_deafen'):
-            self.trigger_action('deafen')
-            triggered = True
-        elif combo_id == self.config.get('btn_mute'):
-            self.trigger_action('mute')
-            triggered = True
-            
-        return triggered
+        actions = self.binding_table.get(combo_id)
+        if not actions and not completed:
+            return False
+        
+        for action in actions or ():
+            self.trigger_action(action)
+        for action in completed:
+            self.trigger_action(action)
+        return True
+
+    def _start_long_press(self, normalized, current_time):
+        """Arm the long press timer for the first key held during binding"""
+        self.first_key_press_time = current_time
+        self.pending_combo = normalized
+        self.long_press_active = False
+        if self.long_press_timer:
+            self.long_press_timer.cancel()
+            self.long_press_timer = None
+        if not self.event_clock:
+            self.long_press_timer = self.scheduler.call_later(
+                self.long_press_threshold, self._long_press_timeout, current_time)
+    
+    def _long_press_timeout(self, pressed_at):
+        """Scheduler callback: hand the long press to the dispatcher, which
+        stays the only thread that writes binding state"""
+        self.input_ring.push(InputEventRing.LONG_PRESS, pressed_at, time.perf_counter_ns())
+    
+    def _long_press_reached(self, current_time):
+        """Long press state as of this event: catches up if the timer hasn't
+        fired yet (it is late, or there is none on the event clock)"""
+        if (not self.long_press_active and self.first_key_press_time is not None
+                and current_time - self.first_key_press_time >= self.long_press_threshold):
+            if self.long_press_timer:
+                self.long_press_timer.cancel()
+                self.long_press_timer = None
+            self._on_long_press(self.pending_combo)
+        return self.long_press_active
+    
+    def _on_long_press(self, normalized):
+        """The first key is still held after the threshold"""
+        if self.long_press_active:
+            return
+        # Check if still pressing the same key
+        if self.binding_target and normalized in self.held:
+            self.long_press_active = True
+            self.pending_combo = normalized
+            self.update_status(f"已鎖定 {normalized}，請按第二個按鍵...")
+            print(f"[DEBUG] Long press detected: {normalized}, waiting for second key...")
 
     def _reset_long_press_state(self):
         """Reset all long press related state"""
+        if self.long_press_timer:
+            self.long_press_timer.cancel()
         self.first_key_press_time = None
         self.pending_combo = None
         self.long_press_active = False
@@ -767,20 +3170,9 @@ class DiscordAPI:
         
         print(f"[DEBUG] Completing binding: {target} = {input_id}")
         
-        if target == 'deafen':
-            self.config['btn_deafen'] = input_id
-        elif target == 'mute':
-            self.config['btn_mute'] = input_id
-        elif target == 'media':
-            self.config['btn_media'] = input_id
-        
-        self.save_config()
+        self.save_config({f'btn_{target}': input_id} if target else None)
         
-        if self.window:
-            try:
-                self.window.evaluate_js(f"updateBinding('{target}', {safe_input})")
-            except Exception as e:
-                print(f"Update binding error: {e}")
+        self.ui.post(f'binding:{target}', f"updateBinding({json.dumps(target)}, {safe_input})")
     
     def _cancel_binding(self):
         """Cancel the current binding and clear it"""
@@ -790,27 +3182,15 @@ class DiscordAPI:
         
         print(f"[DEBUG] ESC pressed - clearing binding for {target}")
         
-        if target == 'deafen':
-            self.config['btn_deafen'] = None
-        elif target == 'mute':
-            self.config['btn_mute'] = None
-        elif target == 'media':
-            self.config['btn_media'] = None
-        
-        self.save_config()
+        self.save_config({f'btn_{target}': None} if target else None)
         
-        if self.window:
-            try:
-                self.window.evaluate_js(f"updateBinding('{target}', 'None')")
-                self.window.evaluate_js(f"showNotification('已取消 {target} 綁定')")
-            except Exception as e:
-                print(f"Update binding error: {e}")
+        self.ui.post(f'binding:{target}', f"updateBinding({json.dumps(target)}, 'None')")
+        self.ui.post('notification', f"showNotification({json.dumps(f'已取消 {target} 綁定')})")
     
-    def on_click(self, x, y, button, pressed):
-        button_str = str(button)
-        normalized = self._normalize_key(button_str)
+    def _handle_click(self, button, pressed, t_ns):
+        normalized = self._key_name(button)
         
-        current_time = time.time()
+        current_time = t_ns / 1e9
         
         if pressed:
             # If in binding mode
@@ -819,265 +3199,154 @@ class DiscordAPI:
                 if normalized == "LMB":
                     return
                 
-                if normalized not in self.pressed_keys:
-                    self.pressed_keys.append(normalized)
+                held = self.held
+                held.press(normalized, button)
                 
                 # If this is the first key pressed, start long press timer
-                if len(self.pressed_keys) == 1 and self.first_key_press_time is None:
-                    self.first_key_press_time = current_time
-                    self.pending_combo = normalized
-                    self.long_press_active = False
-                    
-                    # Start a timer to detect long press
-                    def long_press_check():
-                        time.sleep(self.long_press_threshold)
-                        # Check if still pressing the same key
-                        if self.binding_target and normalized in self.pressed_keys:
-                            self.long_press_active = True
-                            self.pending_combo = normalized
-                            if self.window:
-                                try:
-                                    self.window.evaluate_js(f"updateStatus('已鎖定 {normalized}，請按第二個按鍵...')")
-                                except:
-                                    pass
-                            print(f"[DEBUG] Long press detected: {normalized}, waiting for second key...")
+                if len(held) == 1 and self.first_key_press_time is None:
+                    self._start_long_press(normalized, current_time)
                     
-                    self.long_press_timer = threading.Thread(target=long_press_check, daemon=True)
-                    self.long_press_timer.start()
-                    
-                elif len(self.pressed_keys) >= 2 and self.long_press_active:
+                elif len(held) >= 2 and self._long_press_reached(current_time):
                     # Second key pressed during long press mode - create combo
-                    combo = self._build_combo_string_from_list(self.pressed_keys)
+                    combo = self._build_combo_string_from_list(held.held_names())
                     self.pending_combo = combo
                     print(f"[DEBUG] Combo key detected: {combo}")
-                    if self.window:
-                        try:
-                            self.window.evaluate_js(f"updateStatus('組合鍵: {combo}')")
-                        except:
-                            pass
+                    self.update_status(f"組合鍵: {combo}")
                 return
             
-            # Normal mode - track pressed keys
-            if normalized not in self.pressed_keys:
-                self.pressed_keys.append(normalized)
+            # Normal mode - track held buttons
+            self.held.press(normalized, button)
+            self.last_key_time = current_time
+            self.stroke_open = True
+            
+            # Hold bindings (push-to-talk / push-to-mute) fire on the press edge
+            if normalized in self.hold_table:
+                self._press_holds(normalized)
             
         else:  # Released
             # If in binding mode
             if self.binding_target:
-                if normalized in self.pressed_keys:
-                    self.pressed_keys.remove(normalized)
-                if len(self.pressed_keys) == 0 and self.pending_combo:
+                self.held.release(normalized)
+                if len(self.held) == 0 and self.pending_combo:
                     # Complete binding with the pending combo
                     self._complete_binding(self.pending_combo)
                     self._reset_long_press_state()
                 return
             
             # Normal mode - trigger action on release
-            current_combo_keys = self.pressed_keys.copy()
-            if normalized not in current_combo_keys:
+            current_combo_keys = self.held.held_names()
+            if normalized not in self.held:
                 current_combo_keys.append(normalized) # Ensure releasing key is included
             
             combo_to_check = self._build_combo_string_from_list(current_combo_keys)
             
             # Check matches
-            self._check_and_trigger(combo_to_check)
+            self._check_and_trigger(combo_to_check, current_time)
             
             # Cleanup
-            if normalized in self.pressed_keys:
-                self.pressed_keys.remove(normalized)
-    
-    def _build_combo_string(self):
-        """Build a combo string from currently pressed keys (max 2 keys)"""
-        if not self.pressed_keys:
-            return ""
-        
-        # Sort keys for consistent ordering
-        # Priority: Ctrl, Alt, Shift, Win, then alphabetical
-        priority = {'Ctrl': 0, 'Alt': 1, 'Shift': 2, 'Win': 3}
-        sorted_keys = sorted(self.pressed_keys, 
-                           key=lambda x: (priority.get(x, 10), x))
-        
-        # Take max 2 keys
-        keys_to_use = sorted_keys[:2]
-        return '+'.join(keys_to_use)
+            self.held.release(normalized)
+            if self.active_holds:
+                self._release_holds(normalized)
     
     def _handle_input(self, input_id):
         """Handle input in normal mode - trigger bound actions"""
         print(f"[DEBUG] _handle_input called with: {input_id}")
         
-        # Escape for safe JS injection
-        safe_input = json.dumps(input_id)
-        
         # Update UI with last input
-        if self.window:
-            try:
-                self.window.evaluate_js(f"updateLastInput({safe_input})")
-            except:
-                pass
+        if self._last_input_live():
+            self.ui.post('last_input', f"updateLastInput({json.dumps(input_id)})")
         
         # If in binding mode, ignore (handled elsewhere)
         if self.binding_target or self.binding_pending:
             return
         
         # Normal mode - trigger actions
-        # Media can work without RPC connection
-        if input_id == self.config.get('btn_media'):
-            self.trigger_action('media')
-        
-        # Discord actions need RPC
-        if self.loop and self.rpc_client:
-            if input_id == self.config.get('btn_deafen'):
-                self.trigger_action('deafen')
-            elif input_id == self.config.get('btn_mute'):
-                self.trigger_action('mute')
+        for action in self.binding_table.get(input_id, ()):
+            self.trigger_action(action)
 
     def trigger_action(self, action_type):
-        """Trigger mute/deafen/media action safely"""
+        """Run a built-in action (mute / deafen / media) or a configured macro"""
         print(f"[DEBUG] trigger_action called: {action_type}")
-        print(f"[DEBUG] running={self.running}, loop={self.loop is not None}, rpc={self.rpc_client is not None}")
         
-        # Media action doesn't need RPC
-        if action_type == 'media':
-            threading.Thread(target=self.send_media_key, daemon=True).start()
+        steps = self.config.macros.get(action_type) or ACTION_MACROS.get(action_type)
+        if steps is None:
+            print(f"[API] Unknown action: {action_type}")
             return
         
-        if not self.rpc_client:
-            print("[API] Cannot trigger action: RPC not connected")
-            return
-        
-        # Try to use existing loop if running
-        if self.loop and self.loop.is_running():
-            try:
-                if action_type == 'deafen':
-                    future = asyncio.run_coroutine_threadsafe(self._toggle_deaf(), self.loop)
-                elif action_type == 'mute':
-                    future = asyncio.run_coroutine_threadsafe(self._toggle_mute(), self.loop)
-                else:
-                    return
-                
-                # Add error logging callback
-                def log_error(fut):
-                    try:
-                        fut.result(timeout=1)
-                    except Exception as e:
-                        print(f"[ERROR] Action {action_type} failed: {e}")
-                        # Fallback to sync send
-                        self._sync_trigger_action(action_type)
-                        
-                future.add_done_callback(log_error)
-                return
-            except Exception as e:
-                print(f"[DEBUG] Async trigger failed: {e}, trying sync fallback")
-        
-        # Fallback: use sync method
-        self._sync_trigger_action(action_type)
-    
-    def _sync_trigger_action(self, action_type):
-        """Synchronous fallback for triggering actions when event loop isn't available"""
-        print(f"[DEBUG] _sync_trigger_action called: {action_type}")
-        
-        if not self.rpc_client or not hasattr(self.rpc_client, 'sock_writer'):
-            print("[API] Cannot sync trigger: RPC socket not available")
-            return
-            
-        try:
-            if action_type == 'deafen':
-                new_value = not self.current_voice_settings.get('deaf', False)
-                payload = {
-                    'cmd': 'SET_VOICE_SETTINGS',
-                    'args': {'deaf': new_value},
-                    'nonce': str(time.time())
-                }
-            elif action_type == 'mute':
-                new_value = not self.current_voice_settings.get('mute', False)
-                payload = {
-                    'cmd': 'SET_VOICE_SETTINGS',
-                    'args': {'mute': new_value},
-                    'nonce': str(time.time())
-                }
-            else:
+        # Fast path: Discord-only steps for distinct fields are one frame, sent
+        # from this thread - unless earlier macros are still running
+        fields = [step[1] for step in steps if step[0] == 'voice']
+        if len(fields) == len(steps) and len(set(fields)) == len(fields) and self.actions.idle:
+            if not self.rpc_sender:
+                print("[API] Cannot trigger action: RPC not connected")
                 return
+            future = self.set_voice_settings({step[1]: step[2] for step in steps})
             
-            # Send synchronously
-            payload_json = json.dumps(payload)
-            encoded = payload_json.encode('utf-8')
-            header = struct.pack('<II', 1, len(encoded))
-            
-            # Use a thread to avoid blocking
-            def do_send():
-                try:
-                    # Access the underlying socket directly
-                    sock_writer = self.rpc_client.sock_writer
-                    sock_writer.write(header + encoded)
-                    # Note: drain() is async, but for fire-and-forget this should work
-                    print(f"[DEBUG] Sync send completed for {action_type}")
-                except Exception as e:
-                    print(f"[ERROR] Sync send failed: {e}")
-            
-            threading.Thread(target=do_send, daemon=True).start()
+            def log_error(fut):
+                error = fut.exception()
+                if error:
+                    print(f"[ERROR] Action {action_type} failed: {error}")
             
-        except Exception as e:
-            print(f"[ERROR] _sync_trigger_action failed: {e}")
+            future.add_done_callback(log_error)
+            return
+        
+        self.actions.submit(action_type, steps)
     
     # === UI Update Helpers ===
     
     def update_status(self, message):
-        if self.window:
-            safe_msg = json.dumps(message)
-            try:
-                self.window.evaluate_js(f"updateStatus({safe_msg})")
-            except:
-                pass
-
+        self.ui.post('status', f"updateStatus({json.dumps(message)})")
     
     def update_connection_status(self, connected):
-        if self.window:
-            self.window.evaluate_js(f"updateConnectionStatus({'true' if connected else 'false'})")
+        self.rpc_connected = connected
+        self.ui.post('connection', f"updateConnectionStatus({'true' if connected else 'false'})")
+        self._update_tray_icon()
     
     def update_voice_status(self):
-        deaf = self.current_voice_settings['deaf']
-        mute = self.current_voice_settings['mute']
-        if self.window:
-            self.window.evaluate_js(f"updateVoiceStatus({'true' if deaf else 'false'}, {'true' if mute else 'false'})")
+        state = self.voice_state.view()
+        deaf = state['deaf']
+        mute = state['mute']
+        self.ui.post('voice', f"updateVoiceStatus({'true' if deaf else 'false'}, {'true' if mute else 'false'})")
+        self._update_tray_icon()
     
     # === Tray ===
     
-    def create_tray_image(self):
-        """Create a beautiful Discord-style tray icon with microphone design"""
-        width, height = 64, 64
-        
-        # Create image with transparency support
-        image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-        dc = ImageDraw.Draw(image)
-        
-        # Draw rounded rectangle background with Discord gradient colors
-        # Main background circle - Discord blurple
-        dc.ellipse([2, 2, 62, 62], fill=(88, 101, 242, 255))
-        
-        # Inner subtle highlight ring
-        dc.ellipse([4, 4, 60, 60], fill=(99, 112, 250, 255))
-        dc.ellipse([6, 6, 58, 58], fill=(88, 101, 242, 255))
-        
-        # Draw microphone icon (stylized, centered)
-        mic_color = (255, 255, 255, 255)
-        
-        # Microphone body (pill shape)
-        dc.rounded_rectangle([26, 14, 38, 34], radius=6, fill=mic_color)
-        
-        # Microphone stand arc (U shape around the mic)
-        dc.arc([20, 22, 44, 44], 0, 180, fill=mic_color, width=3)
-        
-        # Microphone stand vertical line
-        dc.rectangle([30, 42, 34, 48], fill=mic_color)
-        
-        # Microphone base (horizontal line)
-        dc.rounded_rectangle([22, 47, 42, 51], radius=2, fill=mic_color)
-        
-        # Convert to RGB for pystray compatibility (with Discord color background)
-        rgb_image = Image.new('RGB', (width, height), (88, 101, 242))
-        rgb_image.paste(image, mask=image.split()[3])
-        
-        return rgb_image
+    def _tray_state(self):
+        if not self.rpc_connected:
+            return 'disconnected'
+        state = self.voice_state.view()
+        if state.get('deaf'):
+            return 'deafened'
+        if state.get('mute'):
+            return 'muted'
+        return 'normal'
+    
+    def _update_tray_icon(self):
+        """Queue a tray sprite swap on the UI thread; callers may be on the input path"""
+        if self.tray_icon is None:
+            return
+        with self.tray_lock:
+            if self.tray_update_pending:
+                return
+            self.tray_update_pending = True
+        self.ui_scheduler.call_later(0, self._swap_tray_icon)
+    
+    def _swap_tray_icon(self):
+        """Swap the running tray icon's sprite in place when the state changes"""
+        # Read the state under the lock too: the last updater in always shows
+        # the latest state, never one a slower thread computed earlier
+        with self.tray_lock:
+            self.tray_update_pending = False
+            state = self._tray_state()
+            if state == self.tray_state:
+                return
+            self.tray_state = state
+            icon = self.tray_icon
+            if icon is not None:
+                try:
+                    icon.show_state(state)
+                except Exception as e:
+                    print(f"[ERROR] Failed to update tray icon: {e}")
     
     def run_tray(self):
         # Prevent duplicate tray icons
@@ -1089,14 +3358,17 @@ class DiscordAPI:
         
         print("[DEBUG] Starting tray icon...")
         try:
-            image = self.create_tray_image()
+            import pystray
             menu = pystray.Menu(
                 pystray.MenuItem("開啟", self.show_window, default=True),
                 pystray.MenuItem("退出", self.quit_app)
             )
-            self.tray_icon = pystray.Icon("DiscordMouseRPC", image, "Discord Mouse Controller", menu)
+            with self.tray_lock:
+                self.tray_state = self._tray_state()
+                icon = self.tray_icon = self.tray_sprites.make_icon(
+                    "DiscordMouseRPC", self.tray_state, "Discord Mouse Controller", menu)
             # Use threading to be absolutely sure we don't block anything
-            self.tray_icon.run() 
+            icon.run() 
         except Exception as e:
             print(f"[ERROR] Failed to start tray icon: {e}")
 
@@ -1105,6 +3377,9 @@ class DiscordAPI:
         if self.window:
             self.window.show()
             self.window.restore()  # Ensure it's not minimized
+            self.ui.set_visible(True)
+        elif self.headless:
+            self.ui_requested.set()  # The main thread creates the window
         if self.tray_icon:
             self.tray_icon.stop()
 
@@ -1114,13 +3389,16 @@ class DiscordAPI:
         self.running = False
         
         # Stop listeners first
-        try:
-            if hasattr(self, 'mouse_listener'):
-                self.mouse_listener.stop()
-            if hasattr(self, 'keyboard_listener'):
-                self.keyboard_listener.stop()
-        except:
-            pass
+        self.stop_input()
+        
+        self.scheduler.stop()
+        self.ui_scheduler.stop()
+        self.input_ring.close()
+        self.oauth.close()
+        self.config_writer.flush()
+        if self.perf.enabled:
+            self.dump_latency_histograms()
+        self.stop_trace_recording()
         
         # Stop tray icon
         try:
@@ -1140,9 +3418,13 @@ class DiscordAPI:
 def on_closing(window):
     """Handle window close"""
     api = window._js_api
-    print(f"[DEBUG] on_closing called. minimize_to_tray={api.config.get('minimize_to_tray')}")
+    print(f"[DEBUG] on_closing called. minimize_to_tray={api.config.minimize_to_tray}")
     
-    if api.config.get('minimize_to_tray'):
+    if api.headless:
+        # Headless: let the window go; webview.start() returns to run_headless
+        api.detach_window()
+        return True
+    elif api.config.minimize_to_tray:
         # Minimize to tray instead of closing
         # We need to prevent the actual close and just hide the window
         print("[DEBUG] Minimize to tray is enabled")
@@ -1158,6 +3440,7 @@ def on_closing(window):
                 time.sleep(0.1)
                 
                 # Then hide the window
+                api.ui.set_visible(False)
                 if window:
                     window.hide()
                     
@@ -1175,35 +3458,31 @@ def on_closing(window):
         # Clean up resources only when actually closing
         print("[DEBUG] Actually closing the app...")
         api.running = False
-        try:
-            if api.mouse_listener:
-                api.mouse_listener.stop()
-        except:
-            pass
-        try:
-            if api.keyboard_listener:
-                api.keyboard_listener.stop()
-        except:
-            pass
+        api.config_writer.flush()
+        api.stop_input()
         if api.loop and api.loop.is_running():
             api.loop.call_soon_threadsafe(api.loop.stop)
         return True  # Allow close
 
 
-def main():
-    # Check if launched with --minimized flag (for startup)
-    start_minimized = '--minimized' in sys.argv
-    
-    if start_minimized:
-        print("[DEBUG] Starting in minimized mode (startup)")
-    
+def startup_report():
+    """--startup-report: start like a login launch, print a STARTUP line once hooks are live, exit"""
     api = DiscordAPI()
+    api.input_source.wait()  # Returns once the OS hooks are installed
+    hooked = time.perf_counter()
     
-    # If starting minimized, we need to set minimize_to_tray to true
-    # and start hidden directly into system tray
-    if start_minimized:
-        api.config['minimize_to_tray'] = True
-        api.save_config()
+    report = {
+        'first_hook_ms': (hooked - _IMPORT_START) * 1000,
+        'first_hook_unix': time.time(),
+        'lazy_modules_loaded': [name for name in LAZY_MODULES if name in sys.modules],
+    }
+    print("STARTUP " + json.dumps(report), flush=True)
+    api.quit_app()
+
+
+def create_window(api):
+    """Create the webview window for api (call webview.start() afterwards)"""
+    import webview
     
     window = webview.create_window(
         title="Discord Mouse Controller",
@@ -1214,21 +3493,11 @@ def main():
         frameless=True,  # Remove native Windows title bar for macOS-style custom title bar
         easy_drag=True,  # Allow window dragging
         js_api=api,
-        background_color='#f5f7fa',
-        hidden=start_minimized  # Start hidden if minimized mode
+        background_color='#f5f7fa'
     )
     
     def on_loaded():
         api.set_window(window)
-        
-        # If started minimized, immediately go to tray
-        if start_minimized:
-            def start_in_tray():
-                time.sleep(0.5)  # Give window time to fully initialize
-                # Start tray icon
-                tray_thread = threading.Thread(target=api.run_tray, daemon=True)
-                tray_thread.start()
-            threading.Thread(target=start_in_tray, daemon=True).start()
     
     window.events.loaded += on_loaded
     
@@ -1237,7 +3506,80 @@ def main():
     
     window.events.closing += handle_closing
     
+    # No UI updates while minimized to the taskbar (older pywebview lacks these events)
+    if hasattr(window.events, 'minimized'):
+        window.events.minimized += lambda: api.ui.set_visible(False)
+    if hasattr(window.events, 'restored'):
+        window.events.restored += lambda: api.ui.set_visible(True)
+    
+    return window
+
+
+def run_headless(api):
+    """--headless / --minimized: hooks, RPC and bindings only; the tray opens a window on demand"""
+    api.headless = True
+    api.ui.set_visible(False)
+    api.auto_connect(delay=0)
+    
+    while True:
+        threading.Thread(target=api.run_tray, daemon=True).start()
+        
+        # Short waits keep Ctrl+C working on the main thread
+        while not api.ui_requested.wait(0.5):
+            pass
+        api.ui_requested.clear()
+        
+        import webview
+        api.ui.set_visible(True)
+        create_window(api)
+        webview.start(debug=False)
+        api.detach_window()  # In case the backend exited without a closing event
+        api.config_writer.flush()
+
+
+def main():
+    if '--startup-report' in sys.argv:
+        startup_report()
+        return
+    
+    # Check if launched with --minimized flag (for startup)
+    start_minimized = '--minimized' in sys.argv
+    
+    if start_minimized:
+        print("[DEBUG] Starting in minimized mode (startup)")
+    
+    # Hooks go live here, before the webview import below
+    api = DiscordAPI()
+    
+    # --latency-trace: record per-stage histograms, dumped to latency_histograms.json on exit
+    if '--latency-trace' in sys.argv:
+        api.set_latency_tracing(True)
+    
+    # --record-trace PATH: record input for replay_input_trace / benchmarks.py replay
+    if '--record-trace' in sys.argv:
+        index = sys.argv.index('--record-trace')
+        if index + 1 < len(sys.argv):
+            api.start_trace_recording(sys.argv[index + 1])
+    
+    # Startup (--minimized) goes straight to the tray too: the webview is
+    # only loaded when 開啟 first shows the window
+    if '--headless' in sys.argv or start_minimized:
+        if start_minimized:
+            api.save_config({'minimize_to_tray': True})
+        print("[DEBUG] Starting headless (no webview)")
+        try:
+            run_headless(api)
+        except KeyboardInterrupt:
+            api.quit_app()
+        return
+    
+    import webview
+    create_window(api)
     webview.start(debug=False)
+    api.config_writer.flush()
+    if api.perf.enabled:
+        api.dump_latency_histograms()
+    api.stop_trace_recording()
 
 
 if __name__ == "__main__":